@@ -0,0 +1,142 @@
+'''
+> Benchmark of the request header parsing of the proxy server
+> compares the old path (the whole buffer searched for the blank line after
+  every recv, then split into lines and the host / port sliced out of the
+  request line, the lines searched again for every header field asked for)
+  with RequestParser (only the new bytes searched, every line copied once as
+  it arrives, the fields parsed once into a dict)
+> the header arrives in pieces of the given sizes ('all': at once), the
+  fields asked for are the ones a GET is asked for in the proxy
+> Usage: python bench/bench_parser.py [rounds]
+'''
+
+import sys, os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from myProxyServer2 import Server, RequestParser
+
+
+small = (b'GET http://www.example.com/index.html HTTP/1.1\r\n'
+         b'Host: www.example.com\r\n'
+         b'User-Agent: Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:65.0) Gecko/20100101 Firefox/65.0\r\n'
+         b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n'
+         b'Accept-Language: en-US,en;q=0.5\r\n'
+         b'Accept-Encoding: gzip, deflate\r\n'
+         b'Connection: keep-alive\r\n'
+         b'Upgrade-Insecure-Requests: 1\r\n'
+         b'\r\n')
+# a header with a big cookie
+big = small[:-2] + b'Cookie: ' + b'; '.join(b'name%d=%s' % (i, b'v' * 60) for i in range(120)) + b'\r\n\r\n'
+
+# besides the keep-alive ones (Connection, Content-Length...)
+looked_up = ('if-none-match', 'if-modified-since', 'range', 'accept-encoding')
+
+cases = [('small', small, 0), ('small', small, 64), ('small', small, 1),
+         ('big', big, 0), ('big', big, 1460), ('big', big, 64)]
+
+
+# the parsing before RequestParser
+def old_split_header(request, length):
+    view = memoryview(request)
+    header = []
+    start = 0
+    while start < length:
+        end = request.find(b'\r\n', start, length)
+        if end == -1:
+            end = length
+        header.append(view[start:end].tobytes())
+        start = end + 2
+    return header
+
+
+def old_parse_request(request, length):
+    header = old_split_header(request, length)
+    method, path, version = header[0].split(' ')
+    index_host = path.find(b'://')
+    if index_host == -1:
+        temp = path
+    else:
+        temp = path[index_host+3:]
+    index_port = temp.find(b':')
+    index_webserver = temp.find(b'/')
+    if index_webserver == -1:
+        index_webserver = len(temp)
+    if (index_port == -1) or (index_webserver < index_port):
+        port = 80
+        webserver = temp[:index_webserver]
+    else:
+        port = int((temp[index_port+1:])[:index_webserver-index_port-1])
+        webserver = temp[:index_port]
+    return method, path, version, webserver, port, header
+
+
+def old_request_field(header, name):
+    for line in header[1:]:
+        field, _, value = line.partition(':')
+        if field.strip().lower() == name:
+            return value.strip()
+    return None
+
+
+def old_wants_keep_alive(version, header):
+    connection = ''
+    for line in header[1:]:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        if name in ('connection', 'proxy-connection'):
+            connection += value.lower()
+        elif name == 'transfer-encoding' or (name == 'content-length' and value.strip() != '0'):
+            return False
+    if 'close' in connection:
+        return False
+    return version == 'HTTP/1.1' or 'keep-alive' in connection
+
+
+def old_path(buf, pieces):
+    end = 0
+    for n in pieces:
+        end += n
+        index = buf.find(b'\r\n\r\n', 0, end)
+        if index != -1:
+            method, path, version, webserver, port, header = old_parse_request(buf, index + 4)
+            old_wants_keep_alive(version, header)
+            for name in looked_up:
+                old_request_field(header, name)
+            return header
+
+
+def new_path(buf, pieces):
+    parser = RequestParser()
+    end = 0
+    for n in pieces:
+        end += n
+        if parser.feed(buf, end):
+            header = parser.parse()
+            server.wants_keep_alive(header.version, header)
+            for name in looked_up:
+                server.request_field(header, name)
+            return header
+
+
+def run(parse, data, piece, rounds):
+    buf = bytearray(65536)
+    buf[:len(data)] = data
+    size = piece or len(data)
+    pieces = [min(size, len(data) - i) for i in range(0, len(data), size)]
+    start = time.time()
+    for i in range(rounds):
+        parse(buf, pieces)
+    return (time.time() - start) / rounds
+
+
+if __name__ == '__main__':
+    server = Server(('', 0))
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print('{:>8} {:>8} {:>8} {:>12} {:>12} {:>8}'.format('header', 'bytes', 'piece', 'old (us)', 'new (us)',
+                                                        'speedup'))
+    for name, data, piece in cases:
+        old = min(run(old_path, data, piece, rounds) for i in range(3))
+        new = min(run(new_path, data, piece, rounds) for i in range(3))
+        print('{:>8} {:>8} {:>8} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(name, len(data), piece or 'all',
+                                                                     old * 1e6, new * 1e6, old / new))
@@ -0,0 +1,59 @@
+'''
+> Benchmark of the receive path of the proxy server
+> compares the old recv_all (1024 byte recv + string concatenation)
+  with Server.recv_all (pooled buffer + recv_into)
+> Usage: python bench/bench_recv.py [read size]
+'''
+
+import socket
+import sys, os
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from myProxyServer2 import Server
+
+
+sizes = [10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024]
+
+
+# the receive loop before the buffer pool
+def old_recv_all(conn):
+    buffer_size = 1024
+    response = ''
+    while True:
+        r = conn.recv(buffer_size)
+        if len(r) == 0:
+            break
+        response += r
+    return response
+
+
+def sender(conn, data):
+    conn.sendall(data)
+    conn.close()
+
+
+def run(recv, data):
+    a, b = socket.socketpair()
+    t = threading.Thread(target=sender, args=(a, data))
+    t.start()
+    start = time.time()
+    response = recv(b)
+    elapsed = time.time() - start
+    t.join()
+    b.close()
+    assert len(response) == len(data)
+    return elapsed
+
+
+if __name__ == '__main__':
+    server = Server(('', 0))
+    if len(sys.argv) > 1:
+        server.recv_size = int(sys.argv[1])
+    print('{:>12} {:>12} {:>12} {:>8}'.format('size', 'old (s)', 'new (s)', 'speedup'))
+    for size in sizes:
+        data = os.urandom(size)
+        old = min(run(old_recv_all, data) for i in range(3))
+        new = min(run(server.recv_all, data) for i in range(3))
+        print('{:>12} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(size, old, new, old / new))
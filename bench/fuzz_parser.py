@@ -0,0 +1,125 @@
+'''
+> Fuzzing of the request header parsing of the proxy server (RequestParser)
+> every file of bench/parser_corpus is fed at once, split in two at every
+  byte and one byte at a time, the results must all be the same
+  (the bad-*.http files must be refused with a ValueError, the
+  incomplete-*.http files must never end)
+> then random changes of the files (bytes flipped, inserted, removed,
+  repeated) are fed at once and in random pieces: anything but a header or
+  a ValueError is a bug of the parser, the input is printed
+> Usage: python bench/fuzz_parser.py [iterations] [seed]
+'''
+
+import sys, os
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from myProxyServer2 import RequestParser
+
+
+corpus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parser_corpus')
+
+# bytes that mean something to the parser
+special = [b'\r', b'\n', b'\r\n', b'\r\n\r\n', b' ', b'\t', b':', b'/', b'?', b'#', b'@', b'[', b']',
+           b'://', b'\x00', b'\xff', b'0', b'65536', b'CONNECT', b'HTTP/1.1']
+
+
+# what feeding data in pieces of these sizes gives:
+# ('header', length, request line parts, host, port, fields), ('bad', message) or ('incomplete',)
+def outcome(data, pieces):
+    buf = bytearray(len(data))
+    buf[:] = data
+    parser = RequestParser()
+    end = 0
+    try:
+        for n in pieces:
+            end += n
+            if parser.feed(buf, end):
+                header = parser.parse()
+                return ('header', parser.length, (header.method, header.target, header.version),
+                        header.host, header.port, sorted(header.fields.items()))
+    except ValueError as e:
+        return ('bad', str(e))
+    return ('incomplete',)
+
+
+def split(data, *at):
+    at = [0] + list(at) + [len(data)]
+    return [at[i + 1] - at[i] for i in range(len(at) - 1)]
+
+
+def random_pieces(data, rand):
+    pieces = []
+    left = len(data)
+    while left:
+        n = min(left, rand.choice((1, 2, 3, rand.randint(1, 64), rand.randint(1, 1460))))
+        pieces.append(n)
+        left -= n
+    return pieces
+
+
+def mutate(data, rand):
+    data = bytearray(data)
+    for i in range(rand.randint(1, 4)):
+        at = rand.randint(0, len(data))
+        change = rand.randint(0, 3)
+        if change == 0 and at < len(data):
+            data[at] = rand.randint(0, 255)
+        elif change == 1:
+            data[at:at] = rand.choice(special)
+        elif change == 2:
+            del data[at:at + rand.randint(1, 8)]
+        else:
+            data[at:at] = data[at:at + rand.randint(1, 32)] * rand.randint(1, 4)
+    return bytes(data)
+
+
+def check_corpus():
+    failed = 0
+    for name in sorted(os.listdir(corpus_dir)):
+        with open(os.path.join(corpus_dir, name), 'rb') as f:
+            data = f.read()
+        whole = outcome(data, [len(data)])
+        results = [outcome(data, split(data, i)) for i in range(1, len(data))]
+        results.append(outcome(data, [1] * len(data)))
+        differ = [r for r in results if r != whole]
+        expected = 'bad' if name.startswith('bad-') else 'incomplete' if name.startswith('incomplete-') else 'header'
+        ok = not differ and whole[0] == expected
+        failed += not ok
+        print('{:<30} {:<12} {}'.format(name, whole[0], 'ok' if ok else 'FAILED'))
+        if differ:
+            print('    at once: {}\n    in pieces: {}'.format(whole, differ[0]))
+        elif not ok:
+            print('    {}'.format(whole))
+    return failed
+
+
+def fuzz(iterations, rand):
+    corpus = []
+    for name in sorted(os.listdir(corpus_dir)):
+        with open(os.path.join(corpus_dir, name), 'rb') as f:
+            corpus.append(f.read())
+    counts = {'header': 0, 'bad': 0, 'incomplete': 0}
+    for i in range(iterations):
+        data = mutate(rand.choice(corpus), rand)
+        try:
+            whole = outcome(data, [len(data)])
+            pieces = outcome(data, random_pieces(data, rand))
+        except Exception:
+            print('parser crashed on {!r}'.format(data))
+            raise
+        if whole != pieces:
+            print('at once and in pieces differ on {!r}\n    {}\n    {}'.format(data, whole, pieces))
+            return False
+        counts[whole[0]] += 1
+    print('\n{} changed requests: {header} headers, {bad} refused, {incomplete} incomplete'.format(iterations,
+                                                                                                  **counts))
+    return True
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    failed = check_corpus()
+    if not fuzz(iterations, random.Random(seed)) or failed:
+        sys.exit(1)
@@ -7,12 +7,1939 @@ import socket
 import sys, os
 import datetime, time
 from thread import start_new_thread
+import threading
+import select, errno, types
+import tempfile, shutil
+import hashlib, json
+from email.utils import parsedate_tz, mktime_tz
+import heapq, itertools, bisect
+import signal
+import sqlite3
+import zlib
+import Queue
+from collections import deque, OrderedDict
+
+# flock() keeps the worker processes from rotating the shared log file at
+# the same time; there is no fcntl on Windows (nor several processes)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# levels of the log records, as in the logging module
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+
+
+# Python 2 has no socket.SO_REUSEPORT, Linux uses 15
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+
+
+# sendfile(out_fd, in_fd, offset, count) -> bytes sent, copies a file to a
+# socket inside the kernel; Python 2 has no os.sendfile, on Linux it is
+# called from libc, elsewhere it is None and the files are read and sent
+sendfile = getattr(os, 'sendfile', None)
+if sendfile is None and sys.platform.startswith('linux'):
+    try:
+        import ctypes, ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _sendfile64 = getattr(_libc, 'sendfile64', None) or _libc.sendfile
+        _sendfile64.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t]
+        _sendfile64.restype = ctypes.c_ssize_t
+
+        def sendfile(out_fd, in_fd, offset, count):
+            pos = ctypes.c_longlong(offset)
+            n = _sendfile64(out_fd, in_fd, ctypes.byref(pos), count)
+            if n < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return n
+    except (ImportError, OSError, AttributeError):
+        sendfile = None
+
+
+# monotonic() -> seconds, a clock that never goes back (time.time() does
+# when the system clock is set), for the request timers; Python 2 has no
+# time.monotonic, on Linux it is clock_gettime(CLOCK_MONOTONIC) from libc,
+# elsewhere time.time
+monotonic = getattr(time, 'monotonic', None)
+if monotonic is None and sys.platform.startswith('linux'):
+    try:
+        import ctypes, ctypes.util
+
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        _clock_gettime.restype = ctypes.c_int
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            t = _timespec()
+            if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return t.tv_sec + t.tv_nsec * 1e-9
+        monotonic()
+    except (ImportError, OSError, AttributeError):
+        monotonic = None
+if monotonic is None:
+    monotonic = time.time
+
+
+# A pool of pre-allocated receive buffers shared by all the threads
+# acquire() hands out a buffer, release() puts it back for the next request
+# so a request does not allocate its own buffers
+class BufferPool:
+    def __init__(self, buffer_size, count):
+        self.buffer_size = buffer_size
+        self.count = count
+        self.lock = threading.Lock()
+        self.free = [bytearray(buffer_size) for i in range(count)]
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        # pool is empty, allocate one more (dropped on release if the pool is full)
+        return bytearray(self.buffer_size)
+
+    def release(self, buf):
+        with self.lock:
+            if len(self.free) < self.count:
+                self.free.append(buf)
+
+
+# The header of a client request, parsed once by RequestParser
+# the lines as they were received (request line first, the blank line
+# last), so the code going through the lines works on it as on a list, and
+# - method, target, version: the parts of the request line
+# - host, port: the remote server, from the target: absolute form
+#   (http://host:port/path), authority form of CONNECT (host:port);
+#   '' and 80 for the origin form (/path), a request made to the proxy itself
+# - fields: header name (lower case) -> value, repeated headers joined by ', '
+class RequestHeader(list):
+    method = target = version = host = None
+    port = 80
+    fields = {}
+
+
+# Reads a request header as it arrives, straight out of the receive buffer
+# feed() is called each time more of the request was received and only
+# searches the new bytes (a header arriving in many small pieces is not
+# searched again from its start), a line is copied out of the buffer once,
+# when its end is in; it returns True once the blank line ending the header
+# is in, then length is the size of the header and parse() returns its
+# RequestHeader
+# a line may end with a bare '\n' instead of '\r\n' (RFC 7230 3.5)
+# a malformed header raises ValueError (from feed() or parse())
+class RequestParser:
+    max_lines = 100
+    default_ports = {b'http': 80, b'https': 443}
+
+    def __init__(self):
+        self.reset()
+
+    # for the next request of the connection, its bytes now start the buffer
+    def reset(self):
+        self.lines = []
+        # where the line being received starts and how far it was searched
+        self.start = 0
+        self.scanned = 0
+        self.length = 0
+
+    # buf[:end] is the request received so far
+    def feed(self, buf, end):
+        if self.length:
+            return True
+        start = self.start
+        index = buf.find(b'\n', self.scanned, end)
+        if index == -1:
+            self.scanned = end
+            return False
+        view = memoryview(buf)
+        lines = self.lines
+        while index != -1:
+            # the line without its '\r'
+            stop = index - 1 if index > start and buf[index - 1:index] == b'\r' else index
+            if stop != start:
+                if len(lines) == self.max_lines:
+                    raise ValueError('too many request header lines')
+                lines.append(view[start:stop].tobytes())
+            elif lines:
+                lines.append(b'')
+                self.length = index + 1
+                return True
+            # an empty line before the request line is skipped
+            start = index + 1
+            index = buf.find(b'\n', start, end)
+        self.start = start
+        self.scanned = end
+        return False
+
+    def parse(self):
+        header = RequestHeader(self.lines)
+        parts = header[0].split(b' ')
+        if len(parts) != 3 or not parts[0] or not parts[1] or not parts[2].startswith(b'HTTP/'):
+            raise ValueError('bad request line')
+        header.method, header.target, header.version = parts
+        fields = header.fields = {}
+        for line in header[1:-1]:
+            name, colon, value = line.partition(b':')
+            # no space before the colon, no line folding
+            if not colon or not name or name[0] in b' \t' or name[-1] in b' \t':
+                raise ValueError('bad request header line')
+            name = name.lower()
+            value = value.strip()
+            if name in fields:
+                fields[name] += b', ' + value
+            else:
+                fields[name] = value
+        header.host, header.port = self.authority(header.method, header.target)
+        return header
+
+    # the host and port of the request target
+    def authority(self, method, target):
+        if method == b'CONNECT':
+            authority, port = target, 443
+        else:
+            index = target.find(b'://')
+            if index == -1:
+                return b'', 80
+            port = self.default_ports.get(target[:index].lower(), 80)
+            authority = target[index + 3:]
+            for c in (b'/', b'?', b'#'):
+                authority = authority.partition(c)[0]
+        authority = authority.rpartition(b'@')[2]
+        if authority.startswith(b'['):
+            # an IPv6 address
+            host, bracket, rest = authority[1:].partition(b']')
+            if not bracket or (rest and not rest.startswith(b':')):
+                raise ValueError('bad host in the request target')
+            number = rest[1:]
+        else:
+            host, _, number = authority.partition(b':')
+        if not host:
+            raise ValueError('no host in the request target')
+        if number:
+            if not number.isdigit() or not 0 < int(number) < 65536:
+                raise ValueError('bad port in the request target')
+            port = int(number)
+        return host, port
+
+
+# Follows a response from the remote server chunk by chunk
+# - done(): the response has ended by its framing (Content-Length or
+#   chunked), the connection can be read no further for this response
+# - complete(): the response arrived completely and can be cached:
+#   the header must have ended and the body must match its framing
+#   (a response without framing ends when the server closes)
+# - reusable(): the connection can carry another request (keep-alive)
+# head_request: the response to a HEAD request, it never has a body
+# decoded: a list to decode a chunked body into, the data of its chunks is
+# appended as it arrives (memoryview slices of the chunks fed, to be used
+# before the next feed); None to only follow the framing
+class ResponseLength:
+    max_head = 65536
+    max_line = 4096
+
+    def __init__(self, head_request=False):
+        self.head_request = head_request
+        self.head = bytearray()
+        self.header_end = -1
+        self.status = 0
+        self.content_length = None
+        self.chunked = False
+        self.keep_alive = False
+        # header name (lower case) -> value, repeated headers joined by ', '
+        self.fields = {}
+        self.length = 0
+        # chunked framing state
+        self.chunk_left = 0
+        self.line = bytearray()
+        self.in_trailer = False
+        self.ended = False
+        self.bad = False
+        self.decoded = None
+
+    def feed(self, chunk):
+        self.length += len(chunk)
+        view = memoryview(chunk)
+        if self.header_end == -1:
+            if len(self.head) > self.max_head:
+                return
+            # only the header is kept, copied until its end is found
+            start = len(self.head)
+            self.head += view[:self.max_head]
+            index = self.head.find(b'\r\n\r\n', max(0, start - 3))
+            if index == -1:
+                return
+            self.header_end = index + 4
+            self.parse_header(bytes(self.head[:index]))
+            view = view[self.header_end - start:]
+        if self.chunked and not self.ended:
+            self.feed_chunked(view)
+
+    def parse_header(self, head):
+        lines = head.split(b'\r\n')
+        status_line = lines[0].split(b' ', 2)
+        version = status_line[0]
+        try:
+            self.status = int(status_line[1])
+        except (IndexError, ValueError):
+            self.bad = True
+            return
+        connection = b''
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            value = value.strip()
+            if name in self.fields:
+                self.fields[name] += b', ' + value
+            else:
+                self.fields[name] = value
+            if name == b'content-length':
+                try:
+                    self.content_length = int(value)
+                except ValueError:
+                    self.bad = True
+            elif name == b'transfer-encoding':
+                self.chunked = b'chunked' in value.lower()
+            elif name == b'connection':
+                connection = value.lower()
+        if self.chunked:
+            # chunked wins over Content-Length
+            self.content_length = None
+        if self.head_request or self.status // 100 == 1 or self.status in (204, 304):
+            # never has a body
+            self.content_length = 0
+            self.chunked = False
+        if version == b'HTTP/1.1':
+            self.keep_alive = b'close' not in connection
+        else:
+            self.keep_alive = b'keep-alive' in connection
+
+    # find where the chunked body ends, the chunk data itself is skipped
+    # (or appended to decoded)
+    def feed_chunked(self, view):
+        i = 0
+        n = len(view)
+        while i < n and not self.ended:
+            if self.chunk_left:
+                take = min(self.chunk_left, n - i)
+                # the CRLF after the data is not data
+                data = min(take, self.chunk_left - 2)
+                if self.decoded is not None and data > 0:
+                    self.decoded.append(view[i:i + data])
+                self.chunk_left -= take
+                i += take
+                continue
+            # a chunk size line or a trailer line, these are short
+            piece = view[i:i + 256].tobytes()
+            j = piece.find(b'\n')
+            if j == -1:
+                self.line += piece
+                i += len(piece)
+                if len(self.line) > self.max_line:
+                    self.bad = self.ended = True
+                continue
+            self.line += piece[:j]
+            i += j + 1
+            line = bytes(self.line).strip()
+            self.line = bytearray()
+            if self.in_trailer:
+                if line == b'':
+                    self.ended = True
+                continue
+            try:
+                size = int(line.split(b';')[0], 16)
+            except ValueError:
+                self.bad = self.ended = True
+                continue
+            if size == 0:
+                self.in_trailer = True
+            else:
+                # the data and the CRLF after it
+                self.chunk_left = size + 2
+
+    def body_length(self):
+        return self.length - self.header_end
+
+    def done(self):
+        if self.header_end == -1:
+            return False
+        if self.bad or self.chunked:
+            return self.ended
+        if self.content_length is not None:
+            return self.body_length() >= self.content_length
+        return False
+
+    def complete(self):
+        if self.header_end == -1 or self.bad or not self.head.startswith(b'HTTP/'):
+            return False
+        if self.chunked:
+            return self.ended
+        if self.content_length is None:
+            # no length given, the body ends when the server closes
+            return True
+        return self.body_length() == self.content_length
+
+    def reusable(self):
+        return self.keep_alive and self.done() and self.complete()
+
+    # a 200 response of a text type, as the server sent it (no
+    # Content-Encoding, no no-transform): it can have a gzip variant
+    def compressible(self):
+        fields = self.fields
+        content_type = fields.get(b'content-type', b'').split(b';')[0].strip().lower()
+        if not (content_type.startswith(b'text/') or content_type.endswith(b'+xml') or content_type in
+                (b'application/javascript', b'application/x-javascript', b'application/json', b'application/xml')):
+            return False
+        return self.status == 200 and fields.get(b'content-encoding', b'identity').lower() == b'identity' \
+            and b'no-transform' not in fields.get(b'cache-control', b'').lower()
+
+
+# A response on its way to the client: rewrites the hop-by-hop headers
+# (Connection, Keep-Alive) for the client connection, and the framing of
+# the body when the client could not tell where it ends otherwise:
+# - no framing, size known (a whole response from the cache): Content-Length
+# - no framing, size not known (read until the remote server closes, or a
+#   download being followed): chunked to an HTTP/1.1 client, its connection
+#   stays open; an HTTP/1.0 client gets it as it is and is closed after
+# - chunked to an HTTP/1.0 client: decoded, the connection closed after
+# feed() takes the response chunk by chunk and returns what to send: nothing
+# until the header is complete, then the new header and the data
+# chunked: the client takes a chunked response (HTTP/1.1)
+# size: the size of the whole response (header and body), if known
+class ClientResponse:
+    hop_headers = (b'connection', b'keep-alive', b'proxy-connection')
+    # the proxy sends gzip variants (set by the Server): a compressible
+    # response sent as it is says it varies with Accept-Encoding too
+    gzip = False
+
+    def __init__(self, keep_alive, head_request=False, chunked=False, size=None):
+        self.received = ResponseLength(head_request)
+        self.keep_alive = keep_alive
+        self.chunked = chunked
+        self.size = size
+        self.head_sent = False
+        # how the body is sent: None (as it is), 'chunk' or 'decode'
+        self.reframe = None
+        # the Content-Length added, None if the header has its framing
+        self.length = None
+        if not chunked:
+            self.received.decoded = []
+
+    def feed(self, chunk):
+        received = self.received
+        received.feed(chunk)
+        if self.head_sent:
+            return self.body(chunk) if self.reframe else chunk
+        if received.header_end == -1:
+            if received.length <= received.max_head:
+                return b''
+            # header too long to rewrite, send it as it is and close after
+            return self.flush()
+        self.head_sent = True
+        fields = received.fields
+        if self.size is not None and b'content-length' not in fields and b'transfer-encoding' not in fields \
+                and received.status >= 200 and received.status not in (204, 304):
+            self.length = self.size - received.header_end
+        if received.bad:
+            self.keep_alive = False
+        elif received.chunked:
+            if not self.chunked:
+                self.reframe = 'decode'
+                self.keep_alive = False
+        elif received.content_length is None and self.length is None:
+            # the connection can only stay open if the client can tell
+            # where the response ends
+            if self.chunked:
+                self.reframe = 'chunk'
+            else:
+                self.keep_alive = False
+        # the body starts in this chunk, the ones before it were all header
+        start = received.header_end - (received.length - len(chunk))
+        body = memoryview(chunk)[start:]
+        return self.client_head() + (self.body(body) if self.reframe else body.tobytes())
+
+    # a piece of the body, as the client gets it
+    def body(self, data):
+        if self.reframe == 'decode':
+            decoded = self.received.decoded
+            out = b''.join(piece.tobytes() for piece in decoded)
+            del decoded[:]
+            return out
+        if not len(data):
+            return b''
+        return b'%x\r\n' % len(data) + memoryview(data).tobytes() + b'\r\n'
+
+    # n bytes of the body were sent without feed() (sendfile)
+    def skip(self, n):
+        self.received.length += n
+
+    # the end of the response, returns what has not been sent yet
+    # ended False: the response was cut short, the connection is closed after
+    def flush(self, ended=True):
+        if not ended:
+            self.keep_alive = False
+        if self.head_sent:
+            if self.reframe == 'chunk' and ended:
+                # the last chunk
+                return b'0\r\n\r\n'
+            return b''
+        self.head_sent = True
+        self.keep_alive = False
+        return bytes(self.received.head)
+
+    def client_head(self):
+        received = self.received
+        lines = bytes(received.head[:received.header_end - 4]).split(b'\r\n')
+        head = [lines[0]]
+        vary = self.gzip and received.compressible()
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            if name in self.hop_headers or (name == b'transfer-encoding' and self.reframe == 'decode'):
+                continue
+            if name == b'vary' and vary:
+                vary = False
+                value = value.strip()
+                if value != b'*' and b'accept-encoding' not in value.lower():
+                    line = b'Vary: ' + value + b', Accept-Encoding'
+            head.append(line)
+        if vary:
+            head.append(b'Vary: Accept-Encoding')
+        if self.length is not None:
+            head.append(b'Content-Length: %d' % self.length)
+        if self.reframe == 'chunk':
+            head.append(b'Transfer-Encoding: chunked')
+        head.append(b'Connection: keep-alive' if self.keep_alive else b'Connection: close')
+        return b'\r\n'.join(head) + b'\r\n\r\n'
+
+    # the client connection can serve the next request
+    def keep(self):
+        return self.keep_alive and self.received.complete()
+
+
+# Idle keep-alive connections to the remote servers, per (host, port)
+# get() hands out the most recently used one that is still open
+class UpstreamPool:
+    def __init__(self, max_per_host, idle_timeout):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # (host, port) -> [(socket, idle since)]
+        self.idle = {}
+        self.last_prune = time.time()
+        self.created = 0
+        self.reused = 0
+
+    def get(self, key):
+        with self.lock:
+            conns = self.idle.get(key)
+            while conns:
+                s, since = conns.pop()
+                if time.time() - since < self.idle_timeout and self.alive(s):
+                    self.reused += 1
+                    return s
+                s.close()
+            self.created += 1
+        return None
+
+    def put(self, key, s):
+        with self.lock:
+            now = time.time()
+            if now - self.last_prune > self.idle_timeout:
+                self.prune(now)
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_per_host:
+                conns.append((s, now))
+                return
+        s.close()
+
+    # close the connections idle for too long, called with the lock held
+    def prune(self, now):
+        self.last_prune = now
+        for key in list(self.idle):
+            conns = self.idle[key]
+            for s, since in conns:
+                if now - since >= self.idle_timeout:
+                    s.close()
+            conns[:] = [(s, since) for s, since in conns if now - since < self.idle_timeout]
+            if not conns:
+                del self.idle[key]
+
+    # an idle connection has nothing to read: data or EOF means the
+    # server has closed it (or sent something it should not have)
+    def alive(self, s):
+        timeout = s.gettimeout()
+        try:
+            s.setblocking(0)
+            s.recv(1, socket.MSG_PEEK)
+            return False
+        except socket.error as e:
+            return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+        finally:
+            s.settimeout(timeout)
+
+
+# Name lookups of the remote servers, cached so a request seldom waits for
+# one (getaddrinfo gives no TTL, an answer is kept for a set time)
+# - the addresses found are kept for ttl seconds, a failed lookup for
+#   negative_ttl seconds: its error is raised again meanwhile, the resolver
+#   is not asked
+# - a name asked refresh_hits times since it was looked up is looked up
+#   again in a background thread once refresh_after of its ttl is past, so
+#   a popular name does not expire while it is in use (a failed refresh
+#   keeps the old addresses until they expire)
+# - lookup(host) returns the IPv4 addresses of host, system_lookup() asks
+#   getaddrinfo; a stub can be given instead (tests, a local resolver)
+# get() only answers from the cache (the event loop asks it first),
+# fetch() looks the name up, resolve() does both
+class Resolver:
+    def __init__(self, ttl, negative_ttl, refresh_hits=3, refresh_after=0.8, max_entries=10000, lookup=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_hits = refresh_hits
+        self.refresh_after = refresh_after
+        self.max_entries = max_entries
+        self.lookup = lookup or self.system_lookup
+        self.lock = threading.Lock()
+        # host -> [addresses or the error, expires, refresh at (None: not
+        # refreshed), hits since looked up]
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.refreshes = 0
+
+    def system_lookup(self, host):
+        return [info[4][0] for info in socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)]
+
+    # the address of host, None if it is not cached
+    def get(self, host):
+        now = monotonic()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is None or entry[1] <= now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            result, expires, refresh_at, hits = entry
+            if isinstance(result, Exception):
+                raise result
+            entry[3] = hits = hits + 1
+            refresh = refresh_at is not None and hits >= self.refresh_hits and now >= refresh_at
+            if refresh:
+                # only one refresh at a time
+                entry[2] = None
+        if refresh:
+            start_new_thread(self.refresh, (host,))
+        return result[0]
+
+    # look host up now (blocking) and cache the answer
+    def fetch(self, host):
+        result = self.ask(host)
+        self.store(host, result)
+        if isinstance(result, Exception):
+            raise result
+        return result[0]
+
+    def resolve(self, host):
+        address = self.get(host)
+        if address is None:
+            address = self.fetch(host)
+        return address
+
+    # the addresses of host, or the error of the lookup
+    def ask(self, host):
+        try:
+            addresses = self.lookup(host)
+            if not addresses:
+                raise socket.gaierror(socket.EAI_NONAME, 'no address for ' + host)
+        except (socket.error, UnicodeError) as e:
+            with self.lock:
+                self.failures += 1
+            return e
+        return addresses
+
+    def refresh(self, host):
+        result = self.ask(host)
+        with self.lock:
+            self.refreshes += 1
+        if not isinstance(result, Exception):
+            self.store(host, result)
+
+    def store(self, host, result):
+        now = monotonic()
+        with self.lock:
+            if host not in self.entries and len(self.entries) >= self.max_entries:
+                self.prune(now)
+            if isinstance(result, Exception):
+                self.entries[host] = [result, now + self.negative_ttl, None, 0]
+            else:
+                self.entries[host] = [result, now + self.ttl, now + self.ttl * self.refresh_after, 0]
+
+    # drop the expired entries, or the one expiring first if none has
+    # called with the lock held
+    def prune(self, now):
+        for host in [host for host, entry in self.entries.items() if entry[1] <= now]:
+            del self.entries[host]
+        if len(self.entries) >= self.max_entries:
+            del self.entries[min(self.entries, key=lambda host: self.entries[host][1])]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'failures': self.failures, 'refreshes': self.refreshes}
+
+
+# The remote server could not be reached, did not answer, or is
+# short-circuited by the CircuitBreaker; raised before anything of the
+# response was sent to the client, who gets bad_connection_response
+class UpstreamError(socket.error):
+    pass
+
+
+# Health of the remote servers, per (host, port)
+# - failures connect or read failures in a row open the circuit: for backoff
+#   seconds the requests to the server fail at once, instead of every one
+#   holding a worker until its timeout
+# - when the time is up one request goes through as a probe (half-open), an
+#   answer closes the circuit, a failure opens it again for twice as long
+#   (at most max_backoff seconds)
+# - a probe that never reports back is given up after probe_timeout seconds
+# allow() is asked before a request is sent, success() / failure() told
+# once the server answered or not
+class CircuitBreaker:
+    def __init__(self, failures, backoff, max_backoff, probe_timeout, max_entries=10000):
+        self.failures = failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.probe_timeout = probe_timeout
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # (host, port) -> [failures in a row, open until (0: closed),
+        # times opened in a row, probe started (None: no probe)]
+        # a server that answers has no entry
+        self.origins = {}
+        self.opened = 0
+        self.rejected = 0
+
+    # False if the requests to key have to fail at once
+    def allow(self, key):
+        now = monotonic()
+        with self.lock:
+            state = self.origins.get(key)
+            if state is None or not state[1]:
+                return True
+            if now >= state[1] and (state[3] is None or now - state[3] >= self.probe_timeout):
+                state[3] = now
+                return True
+            self.rejected += 1
+            return False
+
+    # seconds before the next probe of key
+    def retry_in(self, key):
+        with self.lock:
+            state = self.origins.get(key)
+            return max(0.0, state[1] - monotonic()) if state is not None and state[1] else 0.0
+
+    # the server answered, returns True if its circuit was open
+    def success(self, key):
+        with self.lock:
+            state = self.origins.pop(key, None)
+        return state is not None and state[1] != 0
+
+    # the server did not answer, returns the seconds its circuit is now
+    # open for, None if it stays as it was
+    def failure(self, key):
+        now = monotonic()
+        with self.lock:
+            state = self.origins.get(key)
+            if state is None:
+                if len(self.origins) >= self.max_entries:
+                    self.prune()
+                state = self.origins[key] = [0, 0, 0, None]
+            elif state[1] and state[3] is None:
+                # a request sent before the circuit opened
+                return None
+            state[0] += 1
+            if state[0] < self.failures and not state[1]:
+                return None
+            backoff = min(self.backoff * 2 ** state[2], self.max_backoff)
+            state[1] = now + backoff
+            state[2] += 1
+            state[3] = None
+            self.opened += 1
+            return backoff
+
+    # forget the servers whose circuit is closed, called with the lock held
+    def prune(self):
+        for key in [key for key, state in self.origins.items() if not state[1]]:
+            del self.origins[key]
+
+    def stats(self):
+        with self.lock:
+            down = sum(1 for state in self.origins.values() if state[1])
+            return {'open': down, 'opened': self.opened, 'rejected': self.rejected}
+
+
+# Responses of the hottest cache files kept in memory, in front of the disk
+# cache, keyed by the cache file path
+# the least recently used ones are dropped to stay within max_bytes
+# a response bigger than max_object is never kept, one past its expiry
+# time is dropped by get() and has to be revalidated
+class MemoryCache:
+    def __init__(self, max_bytes, max_object):
+        self.max_bytes = max_bytes
+        self.max_object = max_object
+        self.lock = threading.Lock()
+        # key -> (response (str), expires), oldest first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    # get() for a key that is often not there (a gzip variant): only an
+    # entry with data is counted, as a hit
+    def peek(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    self.size -= len(entry[0])
+                return None
+            self.entries[key] = entry
+            if entry[0]:
+                self.hits += 1
+            return entry[0]
+
+    # (response, expires), None if it is not kept
+    def get_entry(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    self.size -= len(entry[0])
+                self.misses += 1
+                return None
+            # now the most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, key, data, expires):
+        if len(data) > self.max_object or len(data) > self.max_bytes:
+            return
+        # a str, so a thread can send it while another one replaces it
+        data = bytes(data)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = (data, expires)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                key, old = self.entries.popitem(last=False)
+                self.size -= len(old[0])
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+# The index of the cache files: size, last access time and expiry time of
+# every cache file, kept in memory so a hit or a miss needs no stat() or
+# open() to be decided and counted
+# the index is saved to an SQLite file (index_path) every round of run(),
+# and loaded at start in the background: until then (and with several
+# worker processes, which do not see each other's files) lookup() cannot
+# tell a miss and the cache file has to be opened
+# run() is the background evictor: when the cache is over max_bytes or
+# max_files it removes the least recently used files until it is back
+# under low_water of the limits
+# a reader that has the file open keeps reading it after the unlink, one
+# that opens it a moment too late sees a miss
+class DiskCache:
+    suffix = '.cache'
+    low_water = 0.9
+
+    def __init__(self, root, max_bytes, max_files, on_evict=None, index_path=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.on_evict = on_evict
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        # path -> [size, last access, expires (None: not known)]
+        self.entries = {}
+        # paths changed since the index was saved
+        self.dirty = set()
+        self.size = 0
+        self.evictions = 0
+        self.loaded = False
+        # False with several worker processes: a path not in the index
+        # may still have been cached by another process
+        self.complete = True
+
+    # True: cached, False: not cached, None: not known, open the file to see
+    def lookup(self, path):
+        with self.lock:
+            if path in self.entries:
+                return True
+            if self.loaded and self.complete:
+                return False
+        return None
+
+    def touch(self, path, expires=None):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                entry[1] = time.time()
+                if expires is not None:
+                    entry[2] = expires
+                self.dirty.add(path)
+
+    def add(self, path, size, expires=None):
+        with self.lock:
+            old = self.entries.get(path)
+            if old is not None:
+                self.size -= old[0]
+            self.entries[path] = [size, time.time(), expires]
+            self.size += size
+            self.dirty.add(path)
+
+    def forget(self, path):
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= old[0]
+                self.dirty.add(path)
+
+    # read the cache files from disk: the ones written by other worker
+    # processes are added (last access: their mtime), removed ones dropped
+    def scan(self):
+        found = {}
+        for dir, dirs, files in os.walk(self.root):
+            for name in files:
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found[path] = [st.st_size, st.st_mtime, None]
+        with self.lock:
+            for path, entry in found.items():
+                old = self.entries.get(path)
+                if old is not None:
+                    entry[1] = max(entry[1], old[1])
+                    entry[2] = old[2]
+            self.dirty.update(self.entries)
+            self.dirty.update(found)
+            self.entries = found
+            self.size = sum(entry[0] for entry in found.values())
+            self.loaded = True
+
+    def connect(self):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        db = sqlite3.connect(self.index_path, timeout=30)
+        db.execute('CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, size INTEGER, atime REAL, expires REAL)')
+        return db
+
+    # path -> size of the files in the saved index, {} without one
+    def saved_sizes(self):
+        if self.index_path is None or not os.path.exists(self.index_path):
+            return {}
+        db = self.connect()
+        try:
+            rows = db.execute('SELECT path, size FROM entries').fetchall()
+        finally:
+            db.close()
+        return dict((os.path.join(self.root, path), size) for path, size in rows)
+
+    # load the saved index, the entries added or used since the start win
+    def load(self):
+        db = self.connect()
+        try:
+            rows = db.execute('SELECT path, size, atime, expires FROM entries').fetchall()
+        finally:
+            db.close()
+        with self.lock:
+            for path, size, atime, expires in rows:
+                path = os.path.join(self.root, path)
+                if path not in self.entries and path not in self.dirty:
+                    self.entries[path] = [size, atime, expires]
+                    self.size += size
+            self.loaded = True
+
+    # write the entries changed since the last save in one transaction
+    def save(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            rows = [(os.path.relpath(path, self.root),) + tuple(self.entries[path])
+                    for path in dirty if path in self.entries]
+            gone = [(os.path.relpath(path, self.root),) for path in dirty if path not in self.entries]
+        if not rows and not gone:
+            return
+        db = self.connect()
+        try:
+            with db:
+                db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', rows)
+                db.executemany('DELETE FROM entries WHERE path = ?', gone)
+        except:
+            # saved with the next round
+            with self.lock:
+                self.dirty.update(dirty)
+            raise
+        finally:
+            db.close()
+
+    def over(self, factor=1.0):
+        return (self.max_bytes and self.size > self.max_bytes * factor) or \
+               (self.max_files and len(self.entries) > self.max_files * factor)
+
+    def evict(self):
+        with self.lock:
+            if not self.over():
+                return 0
+            # oldest access first, with the access time as it is now
+            victims = sorted(((path, entry[1]) for path, entry in self.entries.items()),
+                             key=lambda victim: victim[1])
+        removed = 0
+        for path, atime in victims:
+            with self.lock:
+                if not self.over(self.low_water):
+                    break
+                entry = self.entries.get(path)
+                if entry is None or entry[1] != atime:
+                    # used (or rewritten) since the victims were chosen
+                    continue
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        continue
+                del self.entries[path]
+                self.dirty.add(path)
+                self.size -= entry[0]
+                self.evictions += 1
+                removed += 1
+            if self.on_evict is not None:
+                self.on_evict(path)
+        return removed
+
+    def run(self, interval, scan_interval):
+        try:
+            if self.index_path is not None and os.path.exists(self.index_path):
+                self.load()
+            else:
+                self.scan()
+        except Exception:
+            # the scan below builds the index
+            pass
+        last_scan = time.time()
+        while True:
+            try:
+                # a single process knows every file it writes, with several
+                # worker processes the directory is read again now and then
+                if not self.loaded or (not self.complete and time.time() - last_scan >= scan_interval):
+                    last_scan = time.time()
+                    self.scan()
+                self.evict()
+                if self.index_path is not None:
+                    self.save()
+            except Exception:
+                # keep evicting, the next round will try again
+                pass
+            time.sleep(interval)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'evictions': self.evictions}
+
+
+# A cache miss being downloaded into its temp file
+# requests for the same response meanwhile read the temp file as it grows
+# instead of asking the remote server again: wait() (threads) and
+# subscribe() (event loop) return once more than pos bytes are written
+# or the download is over
+class Download:
+    def __init__(self, f, temp_dir):
+        self.file = f
+        self.temp_dir = temp_dir
+        self.cond = threading.Condition()
+        self.written = 0
+        self.done = False
+        # the whole response was written (set before done)
+        self.complete = False
+        self.callbacks = []
+        # requests following it from the temp file (under downloads_lock)
+        self.readers = 0
+
+    # called by the writer after the bytes are flushed to the temp file
+    def wrote(self, n):
+        with self.cond:
+            self.written += n
+            self.notify()
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.notify()
+
+    # called with the lock held
+    def notify(self):
+        self.cond.notify_all()
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback((self.written, self.done), None)
+
+    # returns (written, done)
+    # no timeout: the writer has its own timeouts and always calls finish()
+    def wait(self, pos):
+        with self.cond:
+            while self.written <= pos and not self.done:
+                self.cond.wait()
+            return self.written, self.done
+
+    # callback((written, done), None) is called, maybe from another thread
+    def subscribe(self, pos, callback):
+        with self.cond:
+            if self.written <= pos and not self.done:
+                self.callbacks.append(callback)
+                return
+        callback((self.written, self.done), None)
+
+
+# Writes a response from the remote server to its temp file as it arrives
+# a chunked response is decoded on the way: the temp file gets its header
+# without Transfer-Encoding and Content-Length, then only the data of its
+# chunks, its body is the rest of the file (ClientResponse adds the
+# Content-Length when it is sent), so it is sent with sendfile, in ranges or
+# compressed like any other cached response
+# received: the response as it comes (its framing, done() and complete())
+# stored: the response as it is written, for the metadata of the cache file
+# download: the Download other requests read the temp file from
+class CacheWriter:
+    def __init__(self, f, download=None):
+        self.file = f
+        self.download = download
+        self.received = ResponseLength()
+        self.received.decoded = []
+        self.stored = self.received
+        # the start of the response until its header is complete
+        self.pending = bytearray()
+
+    def write(self, chunk):
+        received = self.received
+        if self.pending is None:
+            received.feed(chunk)
+            if self.stored is received:
+                self.put(chunk)
+            else:
+                self.put_decoded()
+            return
+        self.pending += chunk
+        received.feed(chunk)
+        if received.header_end == -1:
+            if len(self.pending) > received.max_head:
+                # no header to rewrite, written as it is (it is never cached)
+                received.decoded = None
+                self.put(self.pending)
+                self.pending = None
+            return
+        pending, self.pending = self.pending, None
+        if not received.chunked or received.fields[b'transfer-encoding'].lower() != b'chunked':
+            # another transfer coding under the chunks stays as it is
+            received.decoded = None
+            self.put(pending)
+            return
+        lines = bytes(received.head[:received.header_end - 4]).split(b'\r\n')
+        head = b'\r\n'.join([line for line in lines if line.partition(b':')[0].strip().lower()
+                              not in (b'transfer-encoding', b'content-length')]) + b'\r\n\r\n'
+        self.stored = ResponseLength()
+        self.stored.feed(head)
+        self.file.write(head)
+        self.put_decoded(len(head))
+
+    # the data of the chunks decoded so far
+    # head: the length of the header written just before it
+    def put_decoded(self, head=0):
+        decoded = self.received.decoded
+        n = 0
+        for data in decoded:
+            self.file.write(data)
+            n += len(data)
+        del decoded[:]
+        self.stored.length += n
+        self.wrote(head + n)
+
+    def put(self, data):
+        self.file.write(data)
+        self.wrote(len(data))
+
+    # with a download the readers of the temp file are told about it
+    def wrote(self, n):
+        if self.download is not None and n:
+            self.file.flush()
+            self.download.wrote(n)
+
+
+# A CONNECT tunnel relayed by an EventLoop, both directions and its stats
+# it is closed when both directions have ended
+class Tunnel:
+    def __init__(self, conn, server, target):
+        self.conn = conn
+        self.server = server
+        self.target = target
+        self.started = time.time()
+        # when bytes last went through, either way
+        self.active = self.started
+        # bytes client -> server and server -> client
+        self.sent = 0
+        self.received = 0
+        self.open = 2
+
+    # end both directions, the relays see the end of their sockets
+    def shutdown(self):
+        for sock in (self.conn, self.server):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    # a direction has ended, returns True if it was the last one
+    def end(self):
+        self.open -= 1
+        if self.open:
+            return False
+        self.conn.close()
+        self.server.close()
+        return True
+
+
+# A pool of worker threads fed from a bounded queue
+# used for the connections in threaded mode and for blocking calls
+# (disk I/O, name lookups) in event mode
+# the callback gets (result, error) when the call is done
+class ThreadPool:
+    # queue_size: 0 for no limit, otherwise submit() fails when the queue is full
+    def __init__(self, workers, queue_size=0):
+        self.workers = workers
+        self.tasks = Queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        # counters for stats()
+        self.started = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        for i in range(workers):
+            start_new_thread(self.work, ())
+
+    # returns False if the queue is full and the call was not queued
+    def submit(self, func, args, callback=None):
+        try:
+            self.tasks.put_nowait((func, args, callback, time.time()))
+        except Queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        return True
+
+    def stats(self):
+        # wait_avg / wait_max only count calls that have started,
+        # oldest is how long the call at the head of the queue has been waiting
+        with self.tasks.mutex:
+            oldest = time.time() - self.tasks.queue[0][3] if self.tasks.queue else 0.0
+        with self.lock:
+            wait_avg = self.wait_total / self.started if self.started else 0.0
+            return {'workers': self.workers, 'queued': self.tasks.qsize(),
+                    'started': self.started, 'rejected': self.rejected,
+                    'wait_avg': wait_avg, 'wait_max': self.wait_max,
+                    'oldest': oldest}
+
+    def work(self):
+        while True:
+            func, args, callback, queued = self.tasks.get()
+            wait = time.time() - queued
+            with self.lock:
+                self.started += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            result, error = None, None
+            try:
+                result = func(*args)
+            except Exception as e:
+                error = e
+            if callback is not None:
+                callback(result, error)
+
+
+# A coroutine of the EventLoop: the stack of generators, the one running
+# on top, and the timer of the request it serves (if it serves one)
+class Task(list):
+    timer = None
+
+
+# A single-threaded event loop for the 'event' serving mode
+# A coroutine is a generator that yields the operation it waits for:
+#   ('accept', sock)             -> (conn, addr), conn is non-blocking
+#   ('recv', sock, size)         -> data, '' when the peer closed
+#   ('recv_into', sock, view)    -> number of bytes read into view, 0 when closed
+#   ('readable', sock, timeout)  -> None once sock can be read, waits timeout
+#                                   seconds instead of the loop's timeout
+#   ('sendall', sock, data)      -> None
+#   ('sendfile', sock, fd, offset, count)
+#                                -> None, sends count bytes of the file from
+#                                   offset with sendfile (stops early at the
+#                                   end of the file)
+#   ('connect', sock, addr)      -> None
+#   ('sleep', seconds)           -> None
+#   ('call', func, args)         -> func(*args), run in the thread pool
+#   ('callback', func, args)     -> func(*args + (callback,)) registers callback,
+#                                   the value of callback(result, error), may be
+#                                   called from any thread
+#   ('return', value)            -> ends the coroutine with a value
+# or another generator, which runs as a sub-coroutine and sends back its value
+# Socket errors and exceptions from 'call' are thrown into the coroutine,
+# a socket operation waiting longer than timeout seconds gets socket.timeout
+# ('accept' never times out)
+# the task running now is current, a coroutine keeps what belongs to its
+# request on it (the RequestTimer)
+class EventLoop:
+    def __init__(self, pool, timeout=None):
+        self.pool = pool
+        self.timeout = timeout
+        # (task, value, error) ready to be resumed, a task is a stack of generators
+        self.ready = deque()
+        # results posted by the thread pool
+        self.done = deque()
+        # fd -> (task, op, token) waiting for the socket to be readable / writable
+        self.readers = {}
+        self.writers = {}
+        self.masks = {}
+        # heap of (deadline, token, waiters, fd, task) for timeouts and sleeps
+        # an entry is stale once its token is no longer the one waiting on fd
+        self.timers = []
+        self.tokens = itertools.count()
+        self.current = None
+        # the thread pool writes to this socket to wake up the loop
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(0)
+        self.wakeup_w.setblocking(0)
+        if hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+            self.epoll.register(self.wakeup_r.fileno(), select.EPOLLIN)
+        else:
+            self.epoll = None
+
+    def spawn(self, coro):
+        self.ready.append((Task([coro]), None, None))
+
+    # called from the thread pool
+    def post(self, task, result, error):
+        self.done.append((task, result, error))
+        try:
+            self.wakeup_w.send(b'x')
+        except socket.error:
+            # the wakeup socket is full, the loop is waking up anyway
+            pass
+
+    def run_forever(self):
+        while True:
+            for i in range(len(self.ready)):
+                task, value, error = self.ready.popleft()
+                self.step(task, value, error)
+            self.poll()
+            self.expire()
+
+    # run the task until it waits for an operation
+    def step(self, task, value, error):
+        self.current = task
+        while True:
+            gen = task[-1]
+            try:
+                if error is not None:
+                    op = gen.throw(error)
+                else:
+                    op = gen.send(value)
+            except StopIteration:
+                value, error = None, None
+                task.pop()
+                if not task:
+                    return
+                continue
+            except Exception as e:
+                value, error = None, e
+                task.pop()
+                if not task:
+                    return
+                continue
+            value, error = None, None
+            if isinstance(op, types.GeneratorType):
+                task.append(op)
+                continue
+            if op[0] == 'return':
+                gen.close()
+                task.pop()
+                if not task:
+                    return
+                value = op[1]
+                continue
+            self.schedule(task, op)
+            return
+
+    def schedule(self, task, op):
+        kind = op[0]
+        if kind == 'call':
+            self.pool.submit(op[1], op[2], lambda result, error: self.post(task, result, error))
+        elif kind == 'callback':
+            op[1](*(op[2] + (lambda result, error: self.post(task, result, error),)))
+        elif kind == 'sleep':
+            heapq.heappush(self.timers, (time.time() + op[1], next(self.tokens), None, None, task))
+        elif kind == 'connect':
+            err = op[1].connect_ex(op[2])
+            if err in (0, errno.EISCONN):
+                self.ready.append((task, None, None))
+            elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                self.wait(self.writers, op[1], task, op)
+            else:
+                self.ready.append((task, None, socket.error(err, os.strerror(err))))
+        elif kind == 'sendall':
+            self.wait(self.writers, op[1], task, ('sendall', op[1], memoryview(op[2])))
+        elif kind == 'sendfile':
+            self.wait(self.writers, op[1], task, op)
+        else:
+            self.wait(self.readers, op[1], task, op)
+
+    def wait(self, waiters, sock, task, op, token=None):
+        fd = sock.fileno()
+        if token is None:
+            # a new operation, a partial send keeps the deadline of its first part
+            token = next(self.tokens)
+            # ('recv_into', sock, buffer, timeout) waits timeout seconds
+            # instead of the loop's timeout
+            timeout = op[3] if op[0] == 'recv_into' and len(op) > 3 and op[3] else self.timeout
+            if op[0] == 'readable' and op[2]:
+                timeout = op[2]
+            if timeout and op[0] != 'accept':
+                heapq.heappush(self.timers, (time.time() + timeout, token, waiters, fd, task))
+        waiters[fd] = (task, op, token)
+        self.update(fd)
+
+    # wake up the sleepers and time out the operations past their deadline
+    def expire(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, token, waiters, fd, task = heapq.heappop(self.timers)
+            if waiters is None:
+                self.ready.append((task, None, None))
+                continue
+            waiting = waiters.get(fd)
+            if waiting is None or waiting[2] != token:
+                # the operation finished in time
+                continue
+            del waiters[fd]
+            self.update(fd)
+            self.ready.append((task, None, socket.timeout('timed out')))
+
+    # keep the epoll registration in line with readers / writers
+    def update(self, fd):
+        if self.epoll is None:
+            return
+        mask = 0
+        if fd in self.readers:
+            mask |= select.EPOLLIN
+        if fd in self.writers:
+            mask |= select.EPOLLOUT
+        old = self.masks.get(fd, 0)
+        if mask == old:
+            return
+        if mask == 0:
+            self.epoll.unregister(fd)
+            del self.masks[fd]
+        elif old == 0:
+            self.epoll.register(fd, mask)
+            self.masks[fd] = mask
+        else:
+            self.epoll.modify(fd, mask)
+            self.masks[fd] = mask
+
+    def poll(self):
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+        else:
+            timeout = -1
+        if self.epoll is not None:
+            events = self.epoll.poll(timeout)
+            readable = [fd for fd, event in events if event & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP)]
+            writable = [fd for fd, event in events if event & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP)]
+        else:
+            rlist = list(self.readers) + [self.wakeup_r.fileno()]
+            readable, writable, _ = select.select(rlist, list(self.writers), [], None if timeout < 0 else timeout)
+        for fd in readable:
+            if fd == self.wakeup_r.fileno():
+                self.wakeup()
+            elif fd in self.readers:
+                self.perform(self.readers, fd)
+        for fd in writable:
+            if fd in self.writers:
+                self.perform(self.writers, fd)
+
+    def wakeup(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+        while self.done:
+            self.ready.append(self.done.popleft())
+
+    # the socket is ready, run the operation the task is waiting for
+    def perform(self, waiters, fd):
+        task, op, token = waiters.pop(fd)
+        self.update(fd)
+        kind, sock = op[0], op[1]
+        try:
+            if kind == 'accept':
+                conn, addr = sock.accept()
+                conn.setblocking(0)
+                result = (conn, addr)
+            elif kind == 'recv':
+                result = sock.recv(op[2])
+            elif kind == 'recv_into':
+                result = sock.recv_into(op[2])
+            elif kind == 'readable':
+                result = None
+            elif kind == 'connect':
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err != 0:
+                    raise socket.error(err, os.strerror(err))
+                result = None
+            elif kind == 'sendfile':
+                fd, offset, count = op[2], op[3], op[4]
+                n = sendfile(sock.fileno(), fd, offset, count)
+                if 0 < n < count:
+                    self.wait(waiters, sock, task, ('sendfile', sock, fd, offset + n, count - n), token)
+                    return
+                result = None
+            else:
+                view = op[2]
+                n = sock.send(view)
+                if n < len(view):
+                    # not everything was sent, wait for the rest
+                    self.wait(waiters, sock, task, ('sendall', sock, view[n:]), token)
+                    return
+                result = None
+        except (socket.error, OSError) as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.wait(waiters, sock, task, op, token)
+            else:
+                self.ready.append((task, None, e))
+            return
+        self.ready.append((task, result, None))
+
+
+# The log file, written by a background thread: log() only puts the record
+# in a queue, every flush_interval seconds the thread writes all the queued
+# records at once (and echoes them on stdout)
+# records under level are dropped, of the DEBUG ones only 1 in debug_sample
+# is kept; when the queue is full (the disk is too slow) records are dropped
+# and counted
+# a new file is started when the file would go over max_bytes or is older
+# than rotate_interval seconds, the last backups files are kept as
+# log.txt.1 (the newest) .. log.txt.<backups>
+# the writer thread is started by the first record of a process, so a
+# worker process forked by serve_prefork gets its own
+# the worker processes append to the same file: the one that rotates it
+# holds its flock(), the others see the file moved and open the new one
+class Logger:
+    max_queue = 100000
+
+    def __init__(self, path, level=INFO, debug_sample=1, max_bytes=0, rotate_interval=0, backups=5,
+                 flush_interval=0.5, echo=True):
+        self.path = path
+        self.level = level
+        self.debug_sample = debug_sample
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.echo = echo
+        self.queue = deque()
+        self.debug_count = itertools.count()
+        self.dropped = 0
+        self.pid = None
+        self.start_lock = threading.Lock()
+        # one flush at a time, the thread's and the one at exit
+        self.write_lock = threading.Lock()
+        self.file = None
+        self.opened = 0
+
+    # a record of this level would be written, to skip building it if not
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, msg, level=INFO):
+        if level < self.level:
+            return
+        if level == DEBUG and self.debug_sample > 1 and next(self.debug_count) % self.debug_sample:
+            return
+        if self.pid != os.getpid():
+            self.start()
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        if isinstance(msg, unicode):
+            msg = msg.encode('utf-8')
+        elif not isinstance(msg, str):
+            # a bytearray from a response dump
+            msg = bytes(msg)
+        self.queue.append(msg)
+
+    def start(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # forked: the parent writes what it had queued, the file is
+                # opened again by this process; the parent's writer thread
+                # may have held the lock at the fork
+                self.queue.clear()
+                self.file = None
+                self.write_lock = threading.Lock()
+            self.pid = os.getpid()
+            start_new_thread(self.run, ())
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                sys.stderr.write('Cannot write the log: ' + str(e) + '\n')
+
+    # write the queued records
+    def flush(self):
+        with self.write_lock:
+            records = []
+            while self.queue:
+                records.append(self.queue.popleft())
+            if self.dropped:
+                records.append('{} log records dropped'.format(self.dropped))
+                self.dropped = 0
+            if not records:
+                return
+            data = '\n'.join(records) + '\n'
+            if self.echo:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            if self.file is not None and self.moved():
+                # rotated by another process
+                self.file.close()
+                self.file = None
+            if self.file is None:
+                self.open()
+            elif (self.max_bytes and 0 < self.file.tell() and self.file.tell() + len(data) > self.max_bytes) or \
+                    (self.rotate_interval and time.time() - self.opened >= self.rotate_interval):
+                self.rotate()
+            self.file.write(data)
+            self.file.flush()
+
+    def open(self):
+        dir = os.path.dirname(self.path)
+        if not os.path.exists(dir):
+            try:
+                os.mkdir(dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.file = open(self.path, 'a')
+        # append mode starts at 0 until the first write
+        self.file.seek(0, os.SEEK_END)
+        self.opened = time.time()
+
+    # the open file is not at path any more (or path is gone)
+    def moved(self):
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except OSError:
+            return True
+
+    # log.txt -> log.txt.1 -> log.txt.2 ..., the oldest one is removed
+    # the renames are done with the lock held, it is released by close()
+    def rotate(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            # not if another process rotated it while this one waited
+            if not self.moved():
+                for i in range(self.backups - 1, 0, -1):
+                    if os.path.exists('{}.{}'.format(self.path, i)):
+                        os.rename('{}.{}'.format(self.path, i), '{}.{}'.format(self.path, i + 1))
+                if self.backups:
+                    os.rename(self.path, self.path + '.1')
+                else:
+                    os.remove(self.path)
+        finally:
+            self.file.close()
+        self.open()
+
+
+# Where the time of one request went, filled in while it is served and
+# added to the Metrics when it is answered
+# phases (seconds, summed when a phase happens more than once):
+#   parse       the request header
+#   dns         the name lookup of the remote server
+#   connect     the new connection to the remote server
+#   upstream    waiting for the response of the remote server
+#   disk_read   the cache file opened and read (not sent with sendfile)
+#   disk_write  the temp file written and moved into place
+#   client      sending the response to the client
+# cache: 'hit' (memory, disk, gzip variant, metadata or ranges of the cache
+# file), 'joined' (read from a download in progress), 'revalidated' (stale,
+# the remote server answered 304), 'miss', 'pass' (not cached: HEAD and
+# CONNECT requests) or 'error'
+# bytes_in: received from the remote server, bytes_out: sent to the client
+# upstream: 'new' or 'reused' connection to the remote server
+class RequestTimer:
+    def __init__(self):
+        self.started = monotonic()
+        self.phases = {}
+        self.cache = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.upstream = None
+        # a request to the proxy itself (its stats), not counted
+        self.internal = False
+
+    # add the time since start to phase, returns now for the next phase
+    def lap(self, phase, start):
+        now = monotonic()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - start
+        return now
+
+
+# Counters and latency histograms of the requests served by this process,
+# shown at /__proxy/stats
+# a histogram counts the requests per bucket of duration, 4 buckets per
+# doubling from 50us to 100s (a percentile is the upper bound of its
+# bucket, within 19%), the last bucket holds the longer ones
+class Metrics:
+    phases = ('total', 'parse', 'dns', 'connect', 'upstream', 'disk_read', 'disk_write', 'client')
+    outcomes = ('hit', 'joined', 'revalidated', 'miss', 'pass', 'error')
+    bounds = [0.00005 * 2 ** (i / 4.0) for i in range(85)]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.cache = dict.fromkeys(self.outcomes, 0)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.upstream = {'new': 0, 'reused': 0}
+        self.counts = dict((phase, [0] * (len(self.bounds) + 1)) for phase in self.phases)
+        self.sums = dict.fromkeys(self.phases, 0.0)
+        self.maxes = dict.fromkeys(self.phases, 0.0)
+
+    # the request is answered
+    def record(self, timer):
+        if timer.internal:
+            return
+        phases = dict(timer.phases)
+        phases['total'] = monotonic() - timer.started
+        with self.lock:
+            self.requests += 1
+            if timer.cache is not None:
+                self.cache[timer.cache] += 1
+            self.bytes_in += timer.bytes_in
+            self.bytes_out += timer.bytes_out
+            if timer.upstream is not None:
+                self.upstream[timer.upstream] += 1
+            for phase, seconds in phases.items():
+                self.counts[phase][bisect.bisect_left(self.bounds, seconds)] += 1
+                self.sums[phase] += seconds
+                if seconds > self.maxes[phase]:
+                    self.maxes[phase] = seconds
+
+    # the duration q (0..1) of the requests are shorter than
+    def percentile(self, counts, total, q, longest):
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.bounds[i], longest) if i < len(self.bounds) else longest
+        return longest
+
+    def stats(self):
+        with self.lock:
+            phases = {}
+            for phase in self.phases:
+                counts = self.counts[phase]
+                total = sum(counts)
+                longest = self.maxes[phase]
+                phases[phase] = {'count': total,
+                                 'avg': self.sums[phase] / total if total else 0.0,
+                                 'p50': self.percentile(counts, total, 0.5, longest),
+                                 'p90': self.percentile(counts, total, 0.9, longest),
+                                 'p99': self.percentile(counts, total, 0.99, longest),
+                                 'max': longest}
+            cache = dict(self.cache)
+            # the requests the cache could have answered
+            cacheable = cache['hit'] + cache['joined'] + cache['revalidated'] + cache['miss']
+            return {'uptime': time.time() - self.started, 'requests': self.requests,
+                    'cache': cache,
+                    'hit_ratio': float(cache['hit'] + cache['joined']) / cacheable if cacheable else 0.0,
+                    'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                    'upstream': dict(self.upstream), 'phases': phases}
 
 
 class Server:
     address_family = socket.AF_INET
     socket_type = socket.SOCK_STREAM
     max_conn = 5
+    # stream cache misses to the client while writing the cache file
+    # False: download the whole response first, then send it
+    stream_relay = True
+    # size of one recv_into() read and of the pooled buffers
+    recv_size = 65536
+    # number of pooled buffers kept around
+    buffer_count = 32
+    # 'threaded': a thread per connection   'event': one event loop for all connections
+    serve_mode = 'threaded'
+    # threads doing blocking disk I/O and name lookups in event mode
+    pool_workers = 4
+    # threaded mode: threads serving connections and connections waiting for one
+    # a connection arriving when the queue is full gets a 503
+    worker_threads = 32
+    queue_size = 64
+    # seconds a worker waits on a silent client / remote server
+    # before the connection is closed
+    client_timeout = 30
+    # keep client connections open between requests (HTTP/1.1 persistent
+    # connections, pipelined requests are answered in order)
+    client_keep_alive = True
+    # seconds an open client connection may wait for its next request
+    # and the number of requests served on one connection
+    keep_alive_timeout = 15
+    max_requests = 100
+    upstream_timeout = 30
+    # set by serve_prefork
+    reuse_port = False
+    # keep connections to the remote servers open and reuse them (HTTP/1.1)
+    upstream_keep_alive = True
+    # idle connections kept per remote server, and for how many seconds
+    upstream_max_per_host = 8
+    upstream_idle_timeout = 30
+    # name lookups of the remote servers are cached: dns_ttl seconds for the
+    # addresses found, dns_negative_ttl seconds for a name not found; a name
+    # asked dns_refresh_hits times is looked up again in the background
+    # before it expires (the lookups can be given to a stub: server.resolver.lookup)
+    dns_ttl = 300
+    dns_negative_ttl = 10
+    dns_refresh_hits = 3
+    # a remote server failing breaker_failures times in a row (no connection,
+    # no answer) is not asked for breaker_backoff seconds, its requests get
+    # bad_connection_response at once; then one request probes it, the
+    # backoff doubles every time the probe fails, up to breaker_max_backoff
+    breaker_failures = 3
+    breaker_backoff = 5
+    breaker_max_backoff = 120
+    # bytes of cached responses kept in memory (0 to turn off) and the
+    # biggest response kept there, bigger ones are always read from disk
+    memory_cache_size = 64 * 1024 * 1024
+    memory_max_object = 1024 * 1024
+    # flush a cache file to the disk before it is renamed into place, so a
+    # crash never leaves a cache file with missing data behind
+    cache_fsync = True
+    # check the cache files at start, in the background: remove the temp
+    # files of downloads cut short and the cache files that do not match
+    # their framing
+    recover_cache = True
+    # seconds a cached response stays fresh when it has no Cache-Control
+    # max-age or Expires header, and the most a guess from Last-Modified
+    # (a tenth of its age) can give; a stale response is revalidated
+    cache_default_ttl = 300
+    cache_heuristic_max = 24 * 3600
+    # limits of the cache directory, in bytes and in files (0: no limit)
+    # the least recently used files are removed by a background thread
+    # every evict_interval seconds, the cache directory is read again every
+    # disk_scan_interval seconds for the files of the other worker processes
+    disk_cache_size = 1024 * 1024 * 1024
+    disk_cache_files = 0
+    evict_interval = 10
+    disk_scan_interval = 300
+    # keep the index of the cache files in cache/index.db, so a restart
+    # knows what is cached without reading the cache directory
+    cache_index = True
+    # Range requests: answered from the cache file when the response is
+    # cached (206, at most max_ranges ranges, more are answered with the
+    # whole response), otherwise sent to the remote server as they are and,
+    # with range_fill, the whole response is fetched into the cache in the
+    # background
+    max_ranges = 16
+    range_fill = True
+    # keep a gzip copy of the cached text responses (HTML, CSS, JavaScript,
+    # JSON, XML, SVG) for the clients that accept it, made on the first hit
+    # of such a client from a response small enough for the memory cache;
+    # the zlib level, 0 to turn it off
+    gzip_level = 6
+    # smaller responses are not worth compressing
+    gzip_min_size = 1024
+    # seconds a CONNECT tunnel may stay idle (no bytes either way) before it
+    # is closed
+    tunnel_idle_timeout = 300
+    # the ports a CONNECT tunnel may go to, the others get a 403
+    connect_ports = (443,)
+    # seconds the accept loop waits when it runs out of file descriptors
+    accept_backoff = 0.1
+    # seconds between two pool stats lines in the log, 0 to turn off
+    stats_interval = 60
+    # the counters and latency percentiles of the requests, asked from the
+    # proxy itself: http://<proxy>/__proxy/stats as text, with ?format=json
+    # (or Accept: application/json) as JSON, '' to turn off
+    # with several worker processes every one answers with its own
+    stats_path = '/__proxy/stats'
+    # the log, log/log.txt: records under log_level are dropped (DEBUG: the
+    # request headers and response dumps), of the DEBUG records 1 in
+    # log_debug_sample is kept
+    log_level = INFO
+    log_debug_sample = 1
+    # a new log file when it would go over log_max_bytes (0: no limit) or
+    # every log_rotate_interval seconds (0: never), log_backups old ones kept
+    log_max_bytes = 10 * 1024 * 1024
+    log_rotate_interval = 0
+    log_backups = 5
+    # seconds between two writes of the log, and echo the log on stdout
+    log_flush_interval = 0.5
+    log_stdout = True
+    # worker processes, each one runs its own listen loop on the same port
+    # (SO_REUSEPORT) so the kernel spreads the connections over all cores
+    processes = 1
+    # a worker dying sooner than this after its start is restarted after a pause
+    respawn_delay = 1
 
     client_page = """
     <html>
@@ -29,124 +1956,438 @@ class Server:
     </body>
     </html>
     """
+    page_bad_connection = """
+    <html>
+    <head>
+    <h>This site can't be reached</h>
+    </head>
+    <body>
+    <p>{msg}</p>
+    <body>
+    </html>
+    """
 
     def __init__(self, server_address):
         self.server_address = server_address
         self.host = server_address[0]
         self.port = int(server_address[1])
+        self.buffers = BufferPool(self.recv_size, self.buffer_count)
+        self.upstreams = UpstreamPool(self.upstream_max_per_host, self.upstream_idle_timeout)
+        self.resolver = Resolver(self.dns_ttl, self.dns_negative_ttl, self.dns_refresh_hits)
+        self.breaker = CircuitBreaker(self.breaker_failures, self.breaker_backoff, self.breaker_max_backoff,
+                                      self.upstream_timeout)
+        self.memory = MemoryCache(self.memory_cache_size, self.memory_max_object)
+        ClientResponse.gzip = bool(self.gzip_level)
+        root = os.path.join(os.getcwd(), 'cache')
+        self.disk = DiskCache(root, self.disk_cache_size, self.disk_cache_files, self.cache_evicted,
+                              os.path.join(root, 'index.db') if self.cache_index else None)
+        # cache file path -> Download, the misses on their way
+        self.downloads = {}
+        self.downloads_lock = threading.Lock()
+        # rendered once, sent when there is no room for a new connection
+        page = self.client_error_page.format(status_code=503, msg='Server is busy, try again later')
+        self.busy_response = self.generate_header_lines(503, len(page)) + page
+        page = self.client_error_page.format(status_code=502, msg='Cannot connect to the server')
+        self.bad_gateway_response = self.generate_header_lines(502, len(page)) + page
+        page = self.client_error_page.format(status_code=403, msg='Tunnels to this port are not allowed')
+        self.forbidden_response = self.generate_header_lines(403, len(page)) + page
+        # sent when the remote server cannot be reached or is short-circuited
+        page = self.page_bad_connection.format(msg='the server could not be reached, try again later')
+        self.bad_connection_response = self.generate_header_lines(502, len(page)) + page
+        # CONNECT tunnels open now and since the start
+        self.tunnels_open = 0
+        self.tunnels_total = 0
+        self.metrics = Metrics()
+        # the RequestTimer of the request a worker thread serves; the event
+        # loop's thread has the loop instead, its timers are on the tasks
+        self.local = threading.local()
+        # for the code running outside of a request (fill_cache), never counted
+        self.no_timer = RequestTimer()
+        self.logger = Logger(os.path.join(os.getcwd(), 'log', 'log.txt'), self.log_level, self.log_debug_sample,
+                             self.log_max_bytes, self.log_rotate_interval, self.log_backups,
+                             self.log_flush_interval, self.log_stdout)
+        # (second, its timestamp string)
+        self.stamp = (None, '')
         
 
     # Function to get timestamp
+    # formatted once a second
     def getTimeStamp(self):
-        return "[" + str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')) + ']'
+        now = int(time.time())
+        stamp = self.stamp
+        if stamp[0] != now:
+            stamp = (now, "[" + str(datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')) + ']')
+            self.stamp = stamp
+        return stamp[1]
     
     # Function to write logs
-    def write_log(self, msg):
-        dir = os.getcwd()
-        dir = os.path.join(dir,'log')
-        if not os.path.exists(dir):
-            os.mkdir('log')
-        with open('log/log.txt', 'a+') as file:
-            file.write(msg)
-            file.write('\n')
+    # only queued, the Logger's thread writes it; never blocks
+    def write_log(self, msg, level=INFO):
+        self.logger.log(msg, level)
     def serve_forever(self):
         try:
-            print(self.getTimeStamp()+' Start listening')
+            if self.recover_cache:
+                # the files written from now on are left alone
+                start_new_thread(self.check_cache_files, (time.time(),))
             self.write_log(self.getTimeStamp()+' Start listening')
-            self.listen(self.max_conn)
+            if self.processes > 1:
+                self.serve_prefork()
+            else:
+                self.serve_worker()
         except KeyboardInterrupt:
-            print(self.getTimeStamp()+' KeyboardInterrupt')
             self.write_log(self.getTimeStamp()+' KeyboardInterrupt')
             time.sleep(.5)
         finally:
-            print(self.getTimeStamp()+' Stopping Server..')
             self.write_log(self.getTimeStamp()+' Stopping Server..\n\n')
+            if self.disk.index_path is not None:
+                try:
+                    self.disk.save()
+                except Exception:
+                    pass
+            self.logger.flush()
             sys.exit()
 
-    def listen(self, max_conn):
+    def serve_worker(self):
+        # loads the index, evicts and saves the index
+        start_new_thread(self.disk.run, (self.evict_interval, self.disk_scan_interval))
+        if self.serve_mode == 'event':
+            self.listen_event(self.max_conn)
+        else:
+            self.listen(self.max_conn)
+
+    # start the worker processes and restart the ones that die
+    def serve_prefork(self):
+        if SO_REUSEPORT is None:
+            self.write_log(self.getTimeStamp() + "   Error: SO_REUSEPORT is not supported, use one process", ERROR)
+            sys.exit(1)
+        self.reuse_port = True
+        # a worker does not see the cache files of the others in its index
+        self.disk.complete = False
+        children = {}
+        # stopping the supervisor stops the workers too (see finally)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            for i in range(self.processes):
+                pid = self.spawn_worker()
+                children[pid] = time.time()
+            while True:
+                pid, status = os.wait()
+                if pid not in children:
+                    continue
+                started = children.pop(pid)
+                self.write_log(self.getTimeStamp() + '   Worker {} exited, status {}, restarting'.format(pid, status))
+                if time.time() - started < self.respawn_delay:
+                    # crashing at start, do not restart it in a tight loop
+                    time.sleep(self.respawn_delay)
+                pid = self.spawn_worker()
+                children[pid] = time.time()
+        finally:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        # in the worker process
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        status = 0
+        try:
+            self.write_log(self.getTimeStamp() + '   Worker {} started'.format(os.getpid()))
+            self.serve_worker()
+        except KeyboardInterrupt:
+            pass
+        except BaseException as e:
+            self.write_log(self.getTimeStamp() + '   Worker {} failed: {}'.format(os.getpid(), e), ERROR)
+            status = 1
+        self.logger.flush()
+        # never return into the supervisor loop
+        os._exit(status)
+
+    def create_listen_socket(self, max_conn):
         try:
             self.listen_socket = socket.socket(self.address_family,self.socket_type)
             self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                # every worker process binds the same port
+                self.listen_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
             self.listen_socket.bind(self.server_address)
-            self.listen_socket.listen(self.max_conn)
+            self.listen_socket.listen(max_conn)
         except:
-            print(self.getTimeStamp() + "   Error: Cannot start listening...")
-            self.write_log(self.getTimeStamp() + "   Error: Cannot start listening...")
+            self.write_log(self.getTimeStamp() + "   Error: Cannot start listening...", ERROR)
             sys.exit(1)
 
+    def listen(self, max_conn):
+        # a deeper backlog, connections over the limit are answered by reject()
+        self.create_listen_socket(max(max_conn, socket.SOMAXCONN))
+        self.workers = ThreadPool(self.worker_threads, self.queue_size)
+        # the CONNECT tunnels are relayed by an event loop of their own, a
+        # worker only connects them
+        self.tunnel_loop = EventLoop(None, self.client_timeout)
+        start_new_thread(self.tunnel_loop.run_forever, ())
+        if self.stats_interval:
+            start_new_thread(self.log_stats, ())
+
         while True:
             try:
                 conn, addr = self.listen_socket.accept()
-                start_new_thread(self.read_request, (conn,addr))
-            except Exception as e:
-                print(self.getTimeStamp() + '   Error: Fail to accept client...'+str(e))
-                self.write_log(self.getTimeStamp() + '   Error: Fail to accept client...'+str(e))
-                sys.exit(1)
-    # a new thread
-    def read_request(self, conn, addr):
-        buffer_size = 65536
-        try:
-            request = conn.recv(buffer_size)
-            header = request.splitlines()
-            # debug
-            print('the header\n',header)
-            self.write_log('\n'.join(line for line in header))
-            method, path, version = header[0].split(' ')
-            # There are different formats of path to parse
-            # get domain and port from the path
-            index_host = path.find(b'://')
-            if index_host == -1:
-                temp = path
-            else:
-                temp = path[index_host+3:] # first strip out http:// or https://
-            
-            #index_port = path.find(b':')
-            index_port = temp.find(b':')
-            #index_webserver = path.find(b'/')
-            index_webserver = temp.find(b'/')
-            if index_webserver == -1:
-                index_webserver = len(temp) # to get full string (substr of len(temp))
-
-            # if there is no port in the path, use port 80 and HTTP (GET)
-            # otherwise, use the port in the header e.g. 443 and HTTPS(CONNECT)
-            webserver = ''
-            port = -1
-            # Try to parse the webserver(host) and port
-            # ignore request from the system
-            if (index_port == -1) or (index_webserver < index_port):
-                port = 80
-                webserver = temp[:index_webserver]
-            else:
-                port = int((temp[index_port+1:])[:index_webserver-index_port-1])
-                webserver = temp[:index_port]
-                    
-            # debug
-            print('     webserver: {}   port: {}'.format(webserver, port))
-            #self.write_log('{}##{}'.format(webserver, port))
-            self.write_log('     webserver: {}   port: {}'.format(webserver, port))
-
-            # handle request 
-            # IS HTTPS CONNECT REQUEST
-            if method == b'CONNECT':
-                print(self.getTimeStamp() + '   HTTPS CONNECT Request')
-                self.write_log(self.getTimeStamp() + '   HTTPS CONNECT Request')
-                # ignore
-                #self.https_proxy(webserver, port, conn, header)
-                return
-            # IS HTTP GET REQUEST
-            elif method == b'GET':
-                print(self.getTimeStamp()+'     HTTP GET Request')
-                self.write_log(self.getTimeStamp()+'     HTTP GET Request')
-                self.http_proxy(webserver, port, conn, header)
-            else:
-                print(self.getTimeStamp()+'    Unexpected Request method')
-                self.write_log(self.getTimeStamp()+'    Unexpected Request method')
-                sys.exit(1)
+                if not self.workers.submit(self.read_request, (conn,addr)):
+                    self.reject(conn)
+            except socket.error as e:
+                # e.g. out of file descriptors or the client went away before accept
+                # skip this connection, the proxy keeps serving
+                self.write_log(self.getTimeStamp() + '   Error: Fail to accept client...'+str(e), ERROR)
+                if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # wait for the workers to free some descriptors
+                    time.sleep(self.accept_backoff)
+
+    # no worker is free and the queue is full: answer 503 and close
+    # never blocks the accept loop, a client not reading the answer loses it
+    def reject(self, conn):
+        try:
+            conn.setblocking(0)
+            # read what the client already sent, closing with unread data
+            # resets the connection and the client would lose the 503
+            conn.recv(self.recv_size)
+        except socket.error:
+            pass
+        try:
+            conn.send(self.busy_response)
+            conn.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        conn.close()
+
+    def pool_stats(self):
+        st = self.workers.stats()
+        return ('workers: {workers}   queued: {queued}   started: {started}   rejected: {rejected}'
+                '   wait avg: {wait_avg:.4f}s   wait max: {wait_max:.4f}s'
+                '   oldest queued: {oldest:.4f}s'
+                '   upstream new: {created}   upstream reused: {reused}'
+                '   memory: {memory[entries]} entries {memory[bytes]} bytes'
+                '   memory hits: {memory[hits]}   memory misses: {memory[misses]}'
+                '   memory evictions: {memory[evictions]}'
+                '   disk: {disk[entries]} files {disk[bytes]} bytes'
+                '   disk evictions: {disk[evictions]}'
+                '   dns: {dns[entries]} names {dns[hits]} hits {dns[misses]} misses'
+                '   servers down: {breaker[open]}   short-circuited: {breaker[rejected]}'
+                '   tunnels: {tunnels_open} open {tunnels_total} total').format(
+                    created=self.upstreams.created, reused=self.upstreams.reused,
+                    tunnels_open=self.tunnels_open, tunnels_total=self.tunnels_total,
+                    memory=self.memory.stats(), disk=self.disk.stats(), dns=self.resolver.stats(),
+                    breaker=self.breaker.stats(), **st)
+
+    # write the worker pool stats to the log every stats_interval seconds
+    def log_stats(self):
+        while True:
+            time.sleep(self.stats_interval)
+            self.write_log(self.getTimeStamp() + '   Pool ' + self.pool_stats())
+
+    # the RequestTimer of the request being served: the worker thread's, or
+    # in the event loop the running task's; no_timer anywhere else
+    def timer(self):
+        loop = getattr(self.local, 'loop', None)
+        timer = loop.current.timer if loop is not None else getattr(self.local, 'timer', None)
+        return timer if timer is not None else self.no_timer
+
+    # the Metrics and the state of the pools and caches of this process
+    def stats(self):
+        st = self.metrics.stats()
+        pool = self.pool if self.serve_mode == 'event' else self.workers
+        st.update({'pid': os.getpid(), 'mode': self.serve_mode, 'pool': pool.stats(),
+                   'memory': self.memory.stats(), 'disk': self.disk.stats(), 'dns': self.resolver.stats(),
+                   'breaker': self.breaker.stats(),
+                   'connections': {'created': self.upstreams.created, 'reused': self.upstreams.reused},
+                   'tunnels': {'open': self.tunnels_open, 'total': self.tunnels_total}})
+        return st
+
+    def stats_text(self, st):
+        lines = ['pid: {pid}   mode: {mode}   uptime: {uptime:.0f}s   requests: {requests}'.format(**st),
+                 'cache: ' + '   '.join('{} {}'.format(outcome, st['cache'][outcome]) for outcome in Metrics.outcomes)
+                 + '   hit ratio: {:.3f}'.format(st['hit_ratio']),
+                 'bytes in: {bytes_in}   bytes out: {bytes_out}'
+                 '   upstream new: {upstream[new]}   upstream reused: {upstream[reused]}'.format(**st),
+                 'pool: {pool[workers]} workers   queued: {pool[queued]}   rejected: {pool[rejected]}'
+                 '   wait max: {pool[wait_max]:.4f}s'.format(**st),
+                 'memory: {memory[entries]} entries {memory[bytes]} bytes'
+                 '   disk: {disk[entries]} files {disk[bytes]} bytes'
+                 '   tunnels: {tunnels[open]} open {tunnels[total]} total'.format(**st),
+                 'dns: {dns[entries]} names   hits: {dns[hits]}   misses: {dns[misses]}'
+                 '   failures: {dns[failures]}   refreshes: {dns[refreshes]}'.format(**st),
+                 'servers down: {breaker[open]}   circuits opened: {breaker[opened]}'
+                 '   short-circuited: {breaker[rejected]}'.format(**st),
+                 '',
+                 '{:<12}{:>9}{:>12}{:>12}{:>12}{:>12}{:>12}'.format('phase (ms)', 'count', 'avg', 'p50', 'p90',
+                                                                   'p99', 'max')]
+        for phase in Metrics.phases:
+            p = st['phases'][phase]
+            lines.append('{:<12}{:>9}'.format(phase, p['count']) +
+                         ''.join('{:>12.3f}'.format(p[key] * 1000) for key in ('avg', 'p50', 'p90', 'p99', 'max')))
+        return '\n'.join(lines) + '\n'
+
+    # a GET of stats_path made to the proxy itself (no host in the request
+    # line), returns the answer, None for any other request
+    def stats_response(self, method, webserver, header, keep_alive=False):
+        if not self.stats_path or webserver or method != b'GET':
+            return None
+        path, _, query = header.target.partition('?')
+        if path != self.stats_path:
+            return None
+        st = self.stats()
+        if 'format=json' in query.split('&') or 'application/json' in (self.request_field(header, 'accept') or ''):
+            body = json.dumps(st, sort_keys=True)
+            content_type = 'application/json'
+        else:
+            body = self.stats_text(st)
+            content_type = 'text/plain'
+        return self.generate_header_lines(200, len(body), keep_alive, content_type) + body
+
+    # run by a worker thread
+    # serves the requests of the connection one after the other until the
+    # client or a response asks to close it, the client stays idle for
+    # keep_alive_timeout seconds or max_requests requests were served
+    # a connection waiting for its next request is given to idle_event, the
+    # worker is free meanwhile; served: the requests served before that
+    def read_request(self, conn, addr, served=0):
+        # the received bytes are buf[:end], a pipelined request
+        # is already there when the one before it is answered
+        buf = self.buffers.acquire()
+        end = 0
+        parser = RequestParser()
+        idle = False
+        try:
+            # a client that never sends its request must not hold a worker forever
+            conn.settimeout(self.client_timeout)
+            while served < self.max_requests:
+                length, end = self.read_header(conn, parser, buf, end)
+                if length == 0:
+                    # the client closed the connection
+                    return
+                # timed from the whole header, not from the wait for it
+                timer = self.local.timer = RequestTimer()
+                header = parser.parse()
+                method, path, version, webserver, port = \
+                    header.method, header.target, header.version, header.host, header.port
+                timer.lap('parse', timer.started)
+                # move the next request (if any) to the start of the buffer
+                buf[:end - length] = buf[length:end]
+                end -= length
+                parser.reset()
+                served += 1
+                keep_alive = served < self.max_requests and self.wants_keep_alive(version, header)
+                # after a CONNECT the bytes left are the start of the tunnel
+                rest = bytes(buf[:end]) if method == b'CONNECT' else b''
+                try:
+                    keep = self.handle_request(conn, method, webserver, port, header, keep_alive, rest)
+                except Exception:
+                    timer.cache = 'error'
+                    raise
+                finally:
+                    self.local.timer = None
+                    self.metrics.record(timer)
+                if not keep:
+                    return
+                if end == 0:
+                    # nothing pipelined, wait for the next request on the tunnel loop
+                    self.tunnel_loop.post(Task([self.idle_event(conn, addr, served)]), None, None)
+                    idle = True
+                    return
+                conn.settimeout(self.keep_alive_timeout)
+        except socket.timeout:
+            # silent client or remote server, free the worker
+            self.write_log(self.getTimeStamp()+'     Timeout, closing the connection')
+            return
         except Exception as e:
-            print(self.getTimeStamp()+'     Error: cannot read quest ' + str(e)+'\n')
-            self.write_log(self.getTimeStamp()+'     Error: cannot read quest '+ str(e)+'\n')
+            self.write_log(self.getTimeStamp()+'     Error: cannot read quest '+ str(e)+'\n', ERROR)
             return
-            
+        finally:
+            self.buffers.release(buf)
+            if not idle:
+                conn.close()
+
+    # threaded mode: an idle keep-alive connection waits on the tunnel loop
+    # for its next request (or its end) without a worker, then goes back to
+    # the worker pool; closed after keep_alive_timeout seconds
+    def idle_event(self, conn, addr, served):
+        try:
+            yield ('readable', conn, self.keep_alive_timeout)
+        except socket.timeout:
+            self.write_log(self.getTimeStamp()+'     Timeout, closing the connection')
+            conn.close()
+            return
+        except Exception:
+            conn.close()
+            return
+        if not self.workers.submit(self.read_request, (conn, addr, served)):
+            self.reject(conn)
+
+    # read until buf[:end] holds a whole request header, the new bytes are
+    # fed to parser as they come
+    # returns the length of the header (0 if the client closed) and the new end
+    def read_header(self, conn, parser, buf, end):
+        view = memoryview(buf)
+        while not parser.feed(buf, end):
+            if end == len(buf):
+                raise ValueError('request header too long')
+            n = conn.recv_into(view[end:])
+            if n == 0:
+                if end:
+                    raise ValueError('connection closed in the request header')
+                return 0, end
+            end += n
+        return parser.length, end
+
+    # the client asks to keep the connection open after this request
+    # a request with a body is not kept, its body would be read as a request
+    def wants_keep_alive(self, version, header):
+        if not self.client_keep_alive:
+            return False
+        fields = header.fields
+        if 'transfer-encoding' in fields or fields.get('content-length', '0') != '0':
+            return False
+        connection = (fields.get('connection', '') + fields.get('proxy-connection', '')).lower()
+        if 'close' in connection:
+            return False
+        return version == 'HTTP/1.1' or 'keep-alive' in connection
+
+    # the client can be sent a chunked response
+    def client_chunked(self, header):
+        return header.version == 'HTTP/1.1'
+
+    # answer one request, returns True if the connection stays open
+    def handle_request(self, conn, method, webserver, port, header, keep_alive, rest=b''):
+        # debug
+        if self.logger.enabled(DEBUG):
+            self.write_log('\n'.join(line for line in header), DEBUG)
+            #self.write_log('{}##{}'.format(webserver, port))
+            self.write_log('     webserver: {}   port: {}'.format(webserver, port), DEBUG)
+
+        stats = self.stats_response(method, webserver, header, keep_alive)
+        if stats is not None:
+            self.timer().internal = True
+            conn.sendall(stats)
+            return keep_alive
+        # handle request 
+        # IS HTTPS CONNECT REQUEST
+        if method == b'CONNECT':
+            self.write_log(self.getTimeStamp() + '   HTTPS CONNECT Request')
+            self.https_proxy(webserver, port, conn, header, rest)
+            return False
+        # IS HTTP GET / HEAD REQUEST
+        elif method in (b'GET', b'HEAD'):
+            self.write_log(self.getTimeStamp()+'     HTTP ' + method + ' Request')
+            try:
+                return self.http_proxy(webserver, port, conn, header, keep_alive)
+            except UpstreamError as e:
+                conn.sendall(self.upstream_down(webserver, e))
+                return False
+        else:
+            self.write_log(self.getTimeStamp()+'    Unexpected Request method')
+            # return, not sys.exit(): the worker thread serves the next connection
+            return False
 
     # We can use HTTP/1.0 to send data back to the client
     # HTTP/1.1 will require a 'Host: ' key and persistent connection
@@ -154,100 +2395,1507 @@ class Server:
     # Do HTTPS requests expect a HTTPS response?
 
     # Generate HTTP response client <=??=> proxy_server
-    def generate_header_lines(self, status, length):
+    def generate_header_lines(self, status, length, keep_alive=False, content_type=None):
         h = ''
         if status == 200:
-            h = 'HTTP/1.0 200 OK\r\n'
+            h = 'HTTP/1.1 200 OK\r\n'
+            h += 'Server: myProxyServer\r\n'
+        elif status == 403:
+            h = 'HTTP/1.1 403 Forbidden\r\n'
             h += 'Server: myProxyServer\r\n'
         elif status == 404:
-            h = 'HTTP/1.0 404 Not Found\r\n'
+            h = 'HTTP/1.1 404 Not Found\r\n'
             h += 'Date: ' + time.strftime('%a, %d %b %Y %H:%M:%S', time.localtime()) + '\r\n'
             h += 'Server: myProxyServer\r\n'
+        elif status == 502:
+            h = 'HTTP/1.1 502 Bad Gateway\r\n'
+            h += 'Server: myProxyServer\r\n'
+        elif status == 503:
+            h = 'HTTP/1.1 503 Service Unavailable\r\n'
+            h += 'Server: myProxyServer\r\n'
+            h += 'Retry-After: 1\r\n'
+        if content_type is not None:
+            h += 'Content-Type: ' + content_type + '\r\n'
         h += 'Content-Length: ' + str(length) + '\r\n'
-        h += 'Connection: close\r\n'
+        if keep_alive:
+            h += 'Connection: keep-alive\r\n'
+        else:
+            h += 'Connection: close\r\n'
         h += '\r\n' # the end of the header and the start of the data
         return h
 
-    # do not handle https for now
-    def https_proxy(self,webserver, port, conn, header):
-        response_content = 'hello from https proxy!\r\n'
-        http_headers = self.generate_header_lines(status=200, length=len(response_content))
-        # debug
-        response = 'HTTP/1.1 200 OK\r\nHost: myProxyServer.com\r\n\r\nHello\r\n'
-        conn.sendall(response)
-        conn.close()
-        #print(response)
+    # a CONNECT request: connect to the remote server, answer 200 and hand
+    # both sockets over to the tunnel loop, the worker thread is free again
+    # rest: what the client sent after the request, the start of the tunnel
+    def https_proxy(self,webserver, port, conn, header, rest=b''):
+        self.timer().cache = 'pass'
+        if not self.connect_allowed(webserver, port):
+            conn.sendall(self.forbidden_response)
+            return
+        try:
+            self.check_upstream(webserver, port)
+            s = self.connect_upstream(webserver, port)
+        except socket.error as e:
+            self.write_log(self.getTimeStamp() + '   Error: cannot connect to ' + webserver + ' ' + str(e), ERROR)
+            conn.sendall(self.bad_gateway_response)
+            return
+        self.upstream_answered(webserver, port)
+        try:
+            conn.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+        except:
+            s.close()
+            raise
+        # the worker closes conn, the tunnel keeps its own reference
+        conn = conn.dup()
+        conn.setblocking(0)
+        s.setblocking(0)
+        self.tunnel_loop.post(Task([self.tunnel_event(self.tunnel_loop, conn, s, webserver, port, rest)]), None, None)
+
+    # a tunnel only goes to the ports of connect_ports, so the proxy
+    # cannot be used to reach any service behind it
+    def connect_allowed(self, webserver, port):
+        if port in self.connect_ports:
+            return True
+        self.write_log(self.getTimeStamp() + '   CONNECT to ' + webserver + ':' + str(port) + ' not allowed',
+                       WARNING)
+        return False
+
+    # relay a CONNECT tunnel both ways on an event loop: one direction runs
+    # here, the other one as a task of its own
+    def tunnel_event(self, loop, conn, s, webserver, port, rest=b''):
+        tunnel = Tunnel(conn, s, '{}:{}'.format(webserver, port))
+        self.tunnels_open += 1
+        self.tunnels_total += 1
+        if rest:
+            try:
+                yield ('sendall', s, rest)
+                tunnel.sent += len(rest)
+            except Exception:
+                # the relays below end right away
+                tunnel.shutdown()
+        loop.spawn(self.pipe_event(tunnel, s, conn))
+        yield self.pipe_event(tunnel, conn, s)
+
+    # one direction of a tunnel: what source sends goes to dest
+    # a pooled buffer is only held while a read is passed on, never while
+    # the tunnel waits, so an idle tunnel costs no buffer
+    def pipe_event(self, tunnel, source, dest):
+        try:
+            while True:
+                try:
+                    yield ('readable', source, self.tunnel_idle_timeout)
+                except socket.timeout:
+                    # idle this way, the tunnel may be busy the other way
+                    if time.time() - tunnel.active < self.tunnel_idle_timeout:
+                        continue
+                    raise
+                buf = self.buffers.acquire()
+                try:
+                    try:
+                        n = source.recv_into(buf)
+                    except socket.error as e:
+                        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                            raise
+                        n = None
+                    if n == 0:
+                        break
+                    if n:
+                        tunnel.active = time.time()
+                        if source is tunnel.conn:
+                            tunnel.sent += n
+                        else:
+                            tunnel.received += n
+                        yield ('sendall', dest, memoryview(buf)[:n])
+                finally:
+                    self.buffers.release(buf)
+            # source closed its side, dest gets the end of it and the
+            # other direction goes on
+            try:
+                dest.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+        except Exception:
+            # reset, timeout or idle: the whole tunnel ends
+            tunnel.shutdown()
+        if tunnel.end():
+            self.tunnels_open -= 1
+            msg = '   Tunnel {} closed: {} bytes up, {} bytes down, {:.1f}s'.format(
+                tunnel.target, tunnel.sent, tunnel.received, time.time() - tunnel.started)
+            self.write_log(self.getTimeStamp() + msg)
 
+    # receive from the socket until it is closed
+    # yields memoryview slices of a pooled buffer, no copy is made
+    # a slice is only valid until the next one is read, copy it to keep it
+    def recv_chunks(self, conn):
+        buf = self.buffers.acquire()
+        view = memoryview(buf)
+        try:
+            while True:
+                n = conn.recv_into(view, self.recv_size)
+                if n == 0:
+                    break
+                yield view[:n]
+        finally:
+            self.buffers.release(buf)
+
+    # returns a bytearray, it is sent and written as it is
+    # so the response is never copied into a str
     def recv_all(self, conn):
-        buffer_size = 1024
-        response = ''
-        while True:
-            r = conn.recv(buffer_size)
-            if len(r) == 0:
-                break
-            response += r
+        # bytearray grows in place, no copy of the whole response per read
+        response = bytearray()
+        for chunk in self.recv_chunks(conn):
+            response += chunk
         return response
     
-    def check_cache(self, webserver, port,conn, header):
+    # stream the response from the remote server to the client
+    # each chunk goes to the client socket and to a temp file right away
+    # the temp file only becomes the cache file if the transfer completes
+    # returns the ClientResponse of the relayed response
+    # first: the start of the response, already read from s
+    # download: the Download to write, other requests are reading it
+    # url: the normalized url, for the cache entry's metadata
+    # chunked: the client takes a chunked response
+    def relay_response(self, webserver, port, s, conn, cache_dir, keep_alive=False, first=None, download=None,
+                       url=None, chunked=False):
+        if download is None:
+            f, temp_dir = self.open_temp_file(cache_dir)
+        else:
+            f, temp_dir = download.file, download.temp_dir
+        writer = CacheWriter(f, download)
+        sent = ClientResponse(keep_alive, chunked=chunked)
+        received = sent.received
+        source = self.recv_chunks(s)
+        chunks = itertools.chain([first], source) if first else source
+        complete = False
+        # the error of a client that left while other requests follow the
+        # download: the response is still downloaded for them, not sent
+        gone = None
+        timer = self.timer()
+        t = monotonic()
+        try:
+            with f:
+                for chunk in chunks:
+                    t = timer.lap('upstream', t)
+                    writer.write(chunk)
+                    t = timer.lap('disk_write', t)
+                    out = sent.feed(chunk)
+                    if gone is not None:
+                        if not self.keep_downloading(cache_dir, download):
+                            raise gone
+                    elif out:
+                        gone = self.send_or_keep(conn, out, cache_dir, download)
+                        t = timer.lap('client', t)
+                    if received.done():
+                        break
+                complete = received.complete()
+                out = sent.flush(complete)
+                if out and gone is None:
+                    gone = self.send_or_keep(conn, out, cache_dir, download)
+                    t = timer.lap('client', t)
+        finally:
+            source.close()
+            timer.bytes_in += received.length
+            if complete:
+                self.release_upstream(webserver, port, s, received)
+            else:
+                s.close()
+            self.end_download(cache_dir, download, complete)
+            t = monotonic()
+            self.commit_cache_file(temp_dir, cache_dir, complete and self.cacheable(received), url, writer.stored)
+            timer.lap('disk_write', t)
+        if gone is not None:
+            raise gone
+        self.write_log(self.getTimeStamp() + '   Relayed ' + str(received.length) + ' bytes')
+        return sent
+
+    # send a piece of a relayed response, returns None
+    # if the client left and other requests follow the download, returns
+    # the error instead of raising it: the download goes on for them
+    def send_or_keep(self, conn, out, cache_dir, download):
+        try:
+            conn.sendall(out)
+        except socket.error as e:
+            if not self.keep_downloading(cache_dir, download):
+                raise
+            self.write_log(self.getTimeStamp() + '   Client gone, downloading for the joined requests')
+            return e
+        return None
+
+    # send a whole response (cache hit or buffered) to the client
+    # returns its ClientResponse
+    def send_response(self, conn, response, keep_alive=False, chunked=False):
+        sent = ClientResponse(keep_alive, chunked=chunked, size=len(response))
+        view = memoryview(response)
+        for i in range(0, len(response), self.recv_size):
+            out = sent.feed(view[i:i + self.recv_size])
+            if out:
+                conn.sendall(out)
+        out = sent.flush()
+        if out:
+            conn.sendall(out)
+        return sent
+
+    # send a cache file to the client, head is its first chunk (already read)
+    # the body goes with sendfile when it can, read and sent otherwise
+    # returns its ClientResponse
+    def send_cached(self, conn, f, head, size, keep_alive=False, chunked=False):
+        sent = ClientResponse(keep_alive, chunked=chunked, size=size)
+        out = sent.feed(head)
+        received = sent.received
+        if sendfile is not None and received.header_end != -1 and not received.chunked:
+            if out:
+                conn.sendall(out)
+            sent.skip(self.send_file(conn, f, len(head), size - len(head)))
+            return sent
+        buf = self.buffers.acquire()
+        view = memoryview(buf)
+        try:
+            while True:
+                if out:
+                    conn.sendall(out)
+                n = f.readinto(buf)
+                if not n:
+                    break
+                out = sent.feed(view[:n])
+            out = sent.flush()
+            if out:
+                conn.sendall(out)
+        finally:
+            self.buffers.release(buf)
+        return sent
+
+    # sendfile() count bytes of f from offset to conn, waiting (within the
+    # timeout of conn) while its send buffer is full
+    # returns the number of bytes sent, less than count if the file is shorter
+    def send_file(self, conn, f, offset, count):
+        timeout = conn.gettimeout()
+        total = 0
+        while count > 0:
+            try:
+                n = sendfile(conn.fileno(), f.fileno(), offset, count)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    raise
+                _, writable, _ = select.select([], [conn], [], timeout)
+                if not writable:
+                    raise socket.timeout('timed out')
+                continue
+            if n == 0:
+                # the file is shorter than it was
+                break
+            offset += n
+            count -= n
+            total += n
+        return total
+
+    # send count bytes of f from offset, with sendfile when it can
+    # returns the number of bytes sent, less than count if the file is shorter
+    def send_range(self, conn, f, offset, count):
+        if sendfile is not None:
+            return self.send_file(conn, f, offset, count)
+        f.seek(offset)
+        buf = self.buffers.acquire()
+        view = memoryview(buf)
+        total = 0
+        try:
+            while total < count:
+                n = f.readinto(view[:min(len(buf), count - total)])
+                if not n:
+                    break
+                conn.sendall(view[:n])
+                total += n
+        finally:
+            self.buffers.release(buf)
+        return total
+
+    # send a range_plan answer, f is closed after
+    # returns its ClientResponse
+    def send_parts(self, conn, f, head, parts, trailer, keep_alive=False):
+        sent = ClientResponse(keep_alive)
+        with f:
+            conn.sendall(sent.feed(head))
+            for prefix, offset, count in parts:
+                if prefix:
+                    conn.sendall(sent.feed(prefix))
+                sent.skip(self.send_range(conn, f, offset, count))
+            if trailer:
+                conn.sendall(sent.feed(trailer))
+        return sent
+
+    # a miss: join the download of the same response if there is one
+    # returns (download, file to read it from) to follow it, or
+    # (download, None) to be the one downloading it into download.file
+    def join_download(self, cache_dir):
+        with self.downloads_lock:
+            download = self.downloads.get(cache_dir)
+            if download is not None:
+                # opened before end_download, so before the temp file is
+                # renamed or removed: the reader keeps it either way
+                # unbuffered, it is only read up to what was written
+                f = open(download.temp_dir, 'rb', 0)
+                download.readers += 1
+                return download, f
+            f, temp_dir = self.open_temp_file(cache_dir)
+            download = Download(f, temp_dir)
+            self.downloads[cache_dir] = download
+            return download, None
+
+    # new requests do not join the download any more
+    # complete: the whole response was written, the readers can end theirs
+    def end_download(self, cache_dir, download, complete=False):
+        if download is None:
+            return
+        if complete:
+            download.complete = True
+        with self.downloads_lock:
+            if self.downloads.get(cache_dir) is download:
+                del self.downloads[cache_dir]
+
+    # a request following the download is done with it
+    def leave_download(self, download):
+        with self.downloads_lock:
+            download.readers -= 1
+
+    # the client of the downloader left: True if other requests still follow
+    # the download, otherwise it stops here and no request joins it any more
+    def keep_downloading(self, cache_dir, download):
+        if download is None:
+            return False
+        with self.downloads_lock:
+            if download.readers > 0:
+                return True
+            if self.downloads.get(cache_dir) is download:
+                del self.downloads[cache_dir]
+            return False
+
+    # the downloader is done, whether it got the response or failed
+    # removes what is left of the temp file and wakes up the readers
+    def finish_download(self, cache_dir, download):
+        try:
+            download.file.close()
+            self.end_download(cache_dir, download)
+            self.commit_cache_file(download.temp_dir, cache_dir, False)
+        finally:
+            download.finish()
+
+    # send the response another request is downloading, from its temp file
+    # returns the ClientResponse, None if the download failed before the
+    # header was sent (the request has to fetch the response itself)
+    def follow_download(self, download, f, conn, keep_alive, chunked=False):
+        sent = ClientResponse(keep_alive, chunked=chunked)
+        buf = self.buffers.acquire()
+        view = memoryview(buf)
+        pos = 0
+        try:
+            with f:
+                while True:
+                    written, done = download.wait(pos)
+                    if written == pos:
+                        break
+                    n = f.readinto(view[:min(len(buf), written - pos)])
+                    if not n:
+                        break
+                    pos += n
+                    out = sent.feed(view[:n])
+                    if out:
+                        conn.sendall(out)
+        finally:
+            self.buffers.release(buf)
+            self.leave_download(download)
+        if not sent.head_sent:
+            return None
+        out = sent.flush(download.complete)
+        if out:
+            conn.sendall(out)
+        return sent
+
+    # a temp file next to the cache file, with a unique name for every writer
+    # so concurrent misses of the same url never write into the same file
+    def open_temp_file(self, cache_dir):
+        fd, temp_dir = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(cache_dir))
+        return os.fdopen(fd, 'wb'), temp_dir
+
+    # move a completely received temp file into place as the cache file
+    # or throw a partial one away
+    # url: written to the metadata file next to the cache file first, so a
+    # cache file never goes without it
+    # received: the ResponseLength of the response, its header goes to the
+    # metadata file too
+    def commit_cache_file(self, temp_dir, cache_dir, complete, url=None, received=None):
+        if complete:
+            if url is not None:
+                self.write_meta(cache_dir, self.cache_meta(url, received))
+            size = os.path.getsize(temp_dir)
+            if self.cache_fsync:
+                self.sync_file(temp_dir)
+            os.rename(temp_dir, cache_dir)
+            if self.cache_fsync:
+                # the rename itself
+                self.sync_file(os.path.dirname(cache_dir))
+            self.disk.add(cache_dir, size)
+            # the old response may still be in memory
+            self.memory.discard(cache_dir)
+            self.drop_variant(cache_dir)
+        elif os.path.exists(temp_dir):
+            # partial response, do not cache it
+            os.remove(temp_dir)
+
+    # the metadata file of a cache file: json with the url of the response
+    # and, so a request can be answered without opening the cache file,
+    # its status, its header and where its body starts in the cache file
+    # and how long it is
+    def meta_path(self, cache_dir):
+        return os.path.splitext(cache_dir)[0] + '.meta'
+
+    def cache_meta(self, url, received=None):
+        meta = {'url': url}
+        if received is not None and received.header_end != -1:
+            meta['status'] = received.status
+            # latin-1 keeps any byte of the header, json needs text
+            meta['head'] = bytes(received.head[:received.header_end]).decode('latin-1')
+            meta['body_offset'] = received.header_end
+            meta['body_length'] = received.body_length()
+        return meta
+
+    def write_meta(self, cache_dir, meta):
+        fd, temp_dir = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(cache_dir))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                json.dump(meta, f)
+            if self.cache_fsync:
+                self.sync_file(temp_dir)
+            os.rename(temp_dir, self.meta_path(cache_dir))
+        except:
+            os.remove(temp_dir)
+            raise
+
+    def read_meta(self, cache_dir):
+        with open(self.meta_path(cache_dir), 'rb') as f:
+            return json.load(f)
+
+    # called by the evictor for every cache file it removed
+    def cache_evicted(self, cache_dir):
+        self.memory.discard(cache_dir)
+        try:
+            os.remove(self.meta_path(cache_dir))
+        except OSError:
+            pass
+
+    def sync_file(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # a cache file is complete if its size matches its header: header plus
+    # Content-Length, or a chunked body ending with the last chunk
+    # only the header and the end of the file are read
+    def cache_file_complete(self, path, size):
+        with open(path, 'rb') as f:
+            head = self.read_cached_head(f)
+            if head is None or not head.startswith(b'HTTP/'):
+                return False
+            received = ResponseLength()
+            received.feed(head)
+            if received.bad:
+                return False
+            if received.chunked:
+                f.seek(max(received.header_end, size - 5))
+                return f.read() == b'0\r\n\r\n'
+        if received.content_length is None:
+            # no length given, ended when the server closed
+            return True
+        return size == received.header_end + received.content_length
+
+    # the recovery pass at start, run in its own thread while requests are
+    # served: only the files older than started are looked at, and a cache
+    # file the saved index has with its size was complete when it was added
+    def check_cache_files(self, started):
+        root = os.path.join(os.getcwd(), 'cache')
+        removed = 0
+        checked = 0
+        try:
+            indexed = self.disk.saved_sizes()
+        except Exception as e:
+            self.write_log(self.getTimeStamp() + '   Error: cannot read the cache index ' + str(e), ERROR)
+            indexed = {}
+        for dir, dirs, files in os.walk(root):
+            # the metadata files last, a cache file removed takes its metadata along
+            for name in sorted(files, key=lambda name: name.endswith('.meta')):
+                path = os.path.join(dir, name)
+                try:
+                    st = os.stat(path)
+                    if st.st_mtime >= started:
+                        # written since the start
+                        continue
+                    if name.endswith('.part'):
+                        # a download cut short by a crash
+                        os.remove(path)
+                        removed += 1
+                    elif name.endswith('.cache'):
+                        if indexed.get(path) == st.st_size:
+                            continue
+                        checked += 1
+                        if not self.cache_file_complete(path, st.st_size) and self.remove_stale(path, started):
+                            self.disk.forget(path)
+                            self.memory.discard(path)
+                            removed += 1
+                    elif name.endswith('.meta'):
+                        if not os.path.exists(os.path.splitext(path)[0] + '.cache') and \
+                                self.remove_stale(path, started):
+                            # a crash after the metadata was written
+                            removed += 1
+                except (IOError, OSError) as e:
+                    self.write_log(self.getTimeStamp() + '   Error: cannot check ' + path + ' ' + str(e), ERROR)
+        self.write_log(self.getTimeStamp() + '   Checked {} cache files, removed {} files'.format(checked, removed))
+
+    # remove path unless it was replaced since started
+    # (a request may commit a new file there while it is checked)
+    def remove_stale(self, path, started):
+        try:
+            if os.stat(path).st_mtime >= started:
+                return False
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    # another thread or worker process may create the same directory first
+    # the parent directories are created too
+    def make_dir(self, dir):
+        parent = os.path.dirname(dir)
+        if not os.path.exists(parent):
+            self.make_dir(parent)
+        try:
+            os.mkdir(dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    # path of the cache file for a request, creates the cache directories
+    def get_cache_dir(self, webserver, header):
+        cache_dir = self.cache_path(webserver, header)
+        dir = os.path.dirname(cache_dir)
+        if not os.path.exists(dir):
+            self.make_dir(dir)
+        self.write_log('FILENAME ' + os.path.basename(cache_dir), DEBUG)
+        return cache_dir
+
+    # path of the cache file for a request, also the key of the memory cache
+    # never touches the disk
+    def cache_path(self, webserver, header):
+        return self.cache_file(self.cache_url(webserver, header))
+
+    # the url of the request in one form for all the ways to write it:
+    # lower case scheme and host, no default port, no fragment
+    def cache_url(self, webserver, header):
+        path = header[0].split(' ')[1]
+        index = path.find('://')
+        if index == -1:
+            # origin form, the host is the one of the request
+            scheme, host = 'http', webserver
+        else:
+            scheme = path[:index].lower()
+            host, slash, path = path[index+3:].partition('/')
+            path = slash + path
+        host = host.lower()
+        if scheme == 'http' and host.endswith(':80'):
+            host = host[:-3]
+        path = path.split('#')[0] or '/'
+        return scheme + '://' + host + path
+
+    # cache/ab/cd/abcd....cache: the sha1 of the url, fanned out over
+    # 256 * 256 directories so none of them gets too big
+    def cache_file(self, url):
+        digest = hashlib.sha1(url).hexdigest()
+        return os.path.join(os.getcwd(), 'cache', digest[:2], digest[2:4], digest + '.cache')
+
+    # the request sent to the remote server
+    # the conditional headers of the client are left out, the proxy needs the
+    # whole response to cache it; conditional: the proxy's own, to revalidate
+    def upstream_request(self, header, conditional=()):
+        h = ''
+        for line in header[:-1]: # the last line is a black line
+            name = line.partition(':')[0].strip().lower()
+            if (not 'Connection' in line) and (not 'Upgrade-Insecure-Requests' in line) \
+                    and name not in ('keep-alive', 'if-none-match', 'if-modified-since'):
+                h  += line + '\r\n'
+        for line in conditional:
+            h += line + '\r\n'
+        if self.upstream_keep_alive:
+            h += 'Connection: keep-alive\r\n\r\n'
+        else:
+            h += 'Connection: close\r\n\r\n'
+        return h
+
+    # send the request to the remote server and read the head of its response
+    # a pooled connection the server closed before answering (its idle
+    # timeout ran out as the request was sent) is not a failure of the
+    # server, the request is sent again once on a new connection
+    # (only GET and HEAD are sent, they can be repeated)
+    # returns the socket, the start of the response and its ResponseLength
+    def request_upstream(self, webserver, port, h, head_request=False):
+        s, reused = self.send_upstream(webserver, port, h)
+        try:
+            first, received = self.recv_head(s, webserver, port, head_request, reused)
+            if reused and not first:
+                s.close()
+                s = None
+                self.write_log(self.getTimeStamp() + '   Pooled connection closed by the server, retrying', DEBUG)
+                s = self.send_upstream(webserver, port, h, False)[0]
+                first, received = self.recv_head(s, webserver, port, head_request)
+        except:
+            if s is not None:
+                s.close()
+            raise
+        return s, first, received
+
+    # connect to the remote server and send the request
+    # an idle keep-alive connection is used if there is one (and pooled),
+    # if the server has closed it meanwhile the request goes over a new
+    # connection; raises UpstreamError at once if the server's circuit is
+    # open (checked once per request: not for a retry)
+    # returns the socket and True if it came from the pool
+    def send_upstream(self, webserver, port, h, pooled=True):
+        s = None
+        if pooled:
+            self.check_upstream(webserver, port)
+            if self.upstream_keep_alive:
+                s = self.upstreams.get((webserver, port))
+        if s is not None:
+            try:
+                s.sendall(h)
+                self.timer().upstream = 'reused'
+                return s, True
+            except socket.error:
+                s.close()
+        s = self.connect_upstream(webserver, port)
+        try:
+            s.sendall(h)
+        except socket.error as e:
+            s.close()
+            raise self.upstream_failed(webserver, port, e)
+        return s, False
+
+    # a new connection to the remote server
+    def connect_upstream(self, webserver, port):
+        timer = self.timer()
+        t = monotonic()
+        try:
+            address = self.resolver.resolve(webserver)
+            t = timer.lap('dns', t)
+            s = socket.create_connection((address, port), self.upstream_timeout)
+        except socket.error as e:
+            raise self.upstream_failed(webserver, port, e)
+        timer.lap('connect', t)
+        timer.upstream = 'new'
+        return s
+
+    # the requests to a remote server whose circuit is open fail at once
+    def check_upstream(self, webserver, port):
+        if not self.breaker.allow((webserver, port)):
+            raise UpstreamError('{}:{} is down, next try in {:.0f}s'.format(
+                webserver, port, self.breaker.retry_in((webserver, port))))
+
+    # the remote server could not be reached or did not answer, counted
+    # against its circuit; returns the UpstreamError to raise
+    def upstream_failed(self, webserver, port, e):
+        backoff = self.breaker.failure((webserver, port))
+        if backoff is not None:
+            self.write_log(self.getTimeStamp() + '   Circuit open for {}:{}, {:.0f}s'.format(webserver, port, backoff),
+                           WARNING)
+        return e if isinstance(e, UpstreamError) else UpstreamError(*e.args)
+
+    # the remote server answered, its circuit is closed
+    def upstream_answered(self, webserver, port):
+        if self.breaker.success((webserver, port)):
+            self.write_log(self.getTimeStamp() + '   Circuit closed for {}:{}'.format(webserver, port), WARNING)
+
+    # the request failed before anything was sent to the client, returns
+    # the answer to send
+    def upstream_down(self, webserver, e):
+        self.timer().cache = 'error'
+        self.write_log(self.getTimeStamp() + '   Error: cannot reach ' + webserver + ' ' + str(e), ERROR)
+        return self.bad_connection_response
+
+    # the response has been read from s: keep the connection for the next
+    # request to the same server if the response allows it
+    def release_upstream(self, webserver, port, s, received):
+        if self.upstream_keep_alive and received.reusable():
+            self.upstreams.put((webserver, port), s)
+        else:
+            s.close()
+
+    # read one response from the remote server, stops at the end of the
+    # response (by its framing) instead of waiting for the server to close
+    # returns the response (bytearray) and its ResponseLength
+    def recv_response(self, s, first=None):
+        response = bytearray()
+        received = ResponseLength()
+        source = self.recv_chunks(s)
+        chunks = itertools.chain([first], source) if first else source
+        timer = self.timer()
+        t = monotonic()
+        try:
+            for chunk in chunks:
+                response += chunk
+                received.feed(chunk)
+                if received.done():
+                    break
+        finally:
+            source.close()
+            timer.lap('upstream', t)
+            timer.bytes_in += received.length
+        return response, received
+
+    # read the header of a response from the remote server
+    # returns what was read (the header and maybe some of the body)
+    # and its ResponseLength
+    # no header (an error, the server closed, the timeout) is a failure
+    # of the server, UpstreamError is raised; but on a pooled connection
+    # closed or reset before any byte came the empty start is returned,
+    # request_upstream retries
+    def recv_head(self, s, webserver, port, head_request=False, pooled=False):
+        data = bytearray()
+        received = ResponseLength(head_request)
+        chunks = self.recv_chunks(s)
+        t = monotonic()
+        try:
+            for chunk in chunks:
+                data += chunk
+                received.feed(chunk)
+                if received.header_end != -1:
+                    break
+        except socket.error as e:
+            if pooled and not data and not isinstance(e, socket.timeout):
+                return data, received
+            raise self.upstream_failed(webserver, port, e)
+        finally:
+            chunks.close()
+            self.timer().lap('upstream', t)
+        if pooled and not data:
+            return data, received
+        if received.header_end == -1:
+            raise self.upstream_failed(webserver, port, UpstreamError('no response from ' + webserver))
+        self.upstream_answered(webserver, port)
+        return data, received
+
+    # the header fields of a cached response
+    def response_fields(self, response):
+        received = ResponseLength()
+        received.feed(memoryview(response)[:received.max_head])
+        return received.fields
+
+    # a time in an HTTP header as a timestamp, None if it cannot be parsed
+    def parse_http_date(self, value):
+        if value is None:
+            return None
+        try:
+            return mktime_tz(parsedate_tz(value))
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    # seconds a response stays fresh after it was received, from its header:
+    # Cache-Control s-maxage / max-age, Expires, then a guess from Last-Modified
+    def freshness_lifetime(self, fields):
+        cache_control = fields.get(b'cache-control', b'').lower()
+        directives = {}
+        for directive in cache_control.split(b','):
+            name, _, value = directive.strip().partition(b'=')
+            directives[name] = value.strip(b'"')
+        if b'no-cache' in directives or b'no-store' in directives:
+            return 0
+        for name in (b's-maxage', b'max-age'):
+            if name in directives:
+                try:
+                    return max(0, int(directives[name]))
+                except ValueError:
+                    return 0
+        date = self.parse_http_date(fields.get(b'date')) or time.time()
+        if b'expires' in fields:
+            # an invalid Expires means already expired
+            expires = self.parse_http_date(fields[b'expires'])
+            return max(0, expires - date) if expires is not None else 0
+        last_modified = self.parse_http_date(fields.get(b'last-modified'))
+        if last_modified is not None:
+            return min(max(0, date - last_modified) / 10, self.cache_heuristic_max)
+        return self.cache_default_ttl
+
+    # the response may be written to the cache
+    # a 206 is only a part of the response, never cached
+    def cacheable(self, received):
+        cache_control = received.fields.get(b'cache-control', b'').lower()
+        return received.status != 206 and b'no-store' not in cache_control and b'private' not in cache_control
+
+    # the headers asking the remote server if a cached response changed
+    def conditional_lines(self, fields):
+        lines = []
+        if b'etag' in fields:
+            lines.append(b'If-None-Match: ' + fields[b'etag'])
+        if b'last-modified' in fields:
+            lines.append(b'If-Modified-Since: ' + fields[b'last-modified'])
+        return lines
+
+    # the value of a header of the client's request, None if it has none
+    def request_field(self, header, name):
+        return header.fields.get(name)
+
+    # the client's If-None-Match / If-Modified-Since match the cached
+    # response (fields), it can be answered with a 304
+    def not_modified(self, fields, header):
+        if_none_match = self.request_field(header, 'if-none-match')
+        if if_none_match is not None:
+            # If-Modified-Since is ignored when If-None-Match is there
+            etag = fields.get(b'etag')
+            if etag is None:
+                return False
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            # weak comparison: W/"x" matches "x"
+            return '*' in tags or etag.replace('W/', '', 1) in [tag.replace('W/', '', 1) for tag in tags]
+        since = self.parse_http_date(self.request_field(header, 'if-modified-since'))
+        last_modified = self.parse_http_date(fields.get(b'last-modified'))
+        return since is not None and last_modified is not None and last_modified <= since
+
+    # the 304 for a cached response header: its status line replaced and
+    # only the headers a 304 carries kept
+    def not_modified_head(self, head):
+        lines = head[:-4].split(b'\r\n')
+        kept = [line for line in lines[1:] if line.partition(b':')[0].strip().lower() in
+                (b'date', b'etag', b'last-modified', b'cache-control', b'expires', b'vary', b'content-location')]
+        return b'\r\n'.join([b'HTTP/1.1 304 Not Modified'] + kept) + b'\r\n\r\n'
+
+    # the metadata of a cached response and the mtime of its cache file
+    # (the cache file is not opened), None if it is not cached
+    def cached_meta(self, cache_dir):
+        if self.disk.lookup(cache_dir) is False:
+            return None
+        try:
+            meta = self.read_meta(cache_dir)
+            mtime = os.stat(cache_dir).st_mtime
+        except (IOError, OSError, ValueError):
+            return None
+        return meta, mtime
+
+    # the header of a cached response, the mtime and the size of its cache
+    # file, from the metadata file, None if it is not cached or its metadata
+    # has no header (written before it was kept there)
+    def cached_head(self, cache_dir):
+        cached = self.cached_meta(cache_dir)
+        if cached is None or 'head' not in cached[0]:
+            return None
+        meta, mtime = cached
+        return meta['head'].encode('latin-1'), mtime, meta['body_offset'] + meta['body_length']
+
+    # a HEAD or a conditional request, the metadata file may answer it
+    def meta_request(self, method, header):
+        return method == 'HEAD' or self.request_field(header, 'if-none-match') is not None \
+            or self.request_field(header, 'if-modified-since') is not None
+
+    # answer a HEAD or a conditional request from the metadata of a fresh
+    # cached response, the body is never read
+    # returns the ClientResponse and what to send, None if the metadata
+    # cannot answer it (not cached, stale, or a GET that needs the body)
+    def meta_response(self, cache_dir, method, header, keep_alive=False):
+        cached = self.cached_head(cache_dir)
+        if cached is None:
+            return None
+        head, mtime, size = cached
+        fields = self.response_fields(head)
+        if time.time() - mtime >= self.freshness_lifetime(fields):
+            # stale, the usual path revalidates it
+            return None
+        status = int(head.split(b' ', 2)[1])
+        if status == 200 and self.not_modified(fields, header):
+            head = self.not_modified_head(head)
+        elif method != 'HEAD':
+            return None
+        # the Content-Length the response would have, if its header has none
+        sent = ClientResponse(keep_alive, True, size=size)
+        return sent, sent.feed(head)
+
+    # the byte ranges of a Range header as (first, last) pairs within a body
+    # of length bytes, overlapping ones merged
+    # None if the header is not a valid bytes range (the whole response is
+    # sent then), [] if none of the ranges is in the body (416)
+    def parse_ranges(self, value, length):
+        unit, _, spec = value.partition('=')
+        if unit.strip().lower() != 'bytes':
+            return None
+        ranges = []
+        for part in spec.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            first, sep, last = part.partition('-')
+            if not sep:
+                return None
+            try:
+                if first.strip() == '':
+                    # the last bytes of the body
+                    count = int(last)
+                    if count > 0 and length > 0:
+                        ranges.append((max(0, length - count), length - 1))
+                    continue
+                first = int(first)
+                last = int(last) if last.strip() else None
+            except ValueError:
+                return None
+            if first < 0 or (last is not None and first > last):
+                return None
+            if first < length:
+                ranges.append((first, length - 1 if last is None else min(last, length - 1)))
+        ranges.sort()
+        merged = []
+        for first, last in ranges:
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+            else:
+                merged.append((first, last))
+        return merged
+
+    # If-Range: the ranges are only sent if the cached response is still the
+    # one the client has a part of (same strong ETag or Last-Modified)
+    def if_range_matches(self, fields, header):
+        if_range = self.request_field(header, 'if-range')
+        if if_range is None:
+            return True
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            etag = fields.get(b'etag')
+            return etag is not None and not etag.startswith('W/') and etag == if_range
+        return fields.get(b'last-modified') == if_range
+
+    # plan the answer to a Range request from the cache file
+    # returns (cached, plan): cached False if the response is not cached,
+    # plan None if the whole response has to be sent instead (stale, not a
+    # 200, chunked, If-Range does not match or an invalid Range), otherwise
+    # (f, head, parts, trailer): the open cache file, the header of the 206
+    # (or 416), the (prefix, offset in f, count) of every range and what
+    # ends the body
+    def range_plan(self, cache_dir, header):
+        cached = self.cached_meta(cache_dir)
+        if cached is None:
+            return False, None
+        meta, mtime = cached
+        if 'head' not in meta or meta['status'] != 200:
+            return True, None
+        head = meta['head'].encode('latin-1')
+        fields = self.response_fields(head)
+        if time.time() - mtime >= self.freshness_lifetime(fields) or b'chunked' in fields.get(b'transfer-encoding', b''):
+            return True, None
+        if not self.if_range_matches(fields, header):
+            return True, None
+        length = meta['body_length']
+        ranges = self.parse_ranges(self.request_field(header, 'range'), length)
+        if ranges is None or len(ranges) > self.max_ranges:
+            return True, None
+        f, mtime, size = self.open_cache_file(cache_dir)
+        if f is None:
+            return False, None
+        if size != meta['body_offset'] + length:
+            # replaced since the metadata was read
+            f.close()
+            return True, None
+        lines = [line for line in head[:-4].split(b'\r\n')[1:]
+                 if line.partition(b':')[0].strip().lower() not in (b'content-length', b'content-range')]
+        parts = []
+        trailer = b''
+        if not ranges:
+            head = b'HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */%d\r\nContent-Length: 0\r\n\r\n' % length
+            return True, (f, head, parts, trailer)
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            parts.append((b'', meta['body_offset'] + first, last - first + 1))
+            lines.append(b'Content-Range: bytes %d-%d/%d' % (first, last, length))
+        else:
+            boundary = os.urandom(12).encode('hex')
+            content_type = fields.get(b'content-type')
+            for first, last in ranges:
+                prefix = b'\r\n--' + boundary + b'\r\n'
+                if content_type is not None:
+                    prefix += b'Content-Type: ' + content_type + b'\r\n'
+                prefix += b'Content-Range: bytes %d-%d/%d\r\n\r\n' % (first, last, length)
+                parts.append((prefix, meta['body_offset'] + first, last - first + 1))
+            trailer = b'\r\n--' + boundary + b'--\r\n'
+            lines = [line for line in lines if line.partition(b':')[0].strip().lower() != b'content-type']
+            lines.append(b'Content-Type: multipart/byteranges; boundary=' + boundary)
+        body = sum(len(prefix) + count for prefix, offset, count in parts) + len(trailer)
+        lines.append(b'Content-Length: %d' % body)
+        head = b'\r\n'.join([b'HTTP/1.1 206 Partial Content'] + lines) + b'\r\n\r\n'
+        return True, (f, head, parts, trailer)
+
+    # the gzip variant of a cache file is a cache file of its own, next to it
+    def variant_path(self, cache_dir):
+        return os.path.splitext(cache_dir)[0] + '.gz' + DiskCache.suffix
+
+    # a new response replaced the cache file, its gzip variant goes too
+    def drop_variant(self, cache_dir):
+        path = self.variant_path(cache_dir)
+        self.memory.discard(path)
+        if self.disk.lookup(path) is False:
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        self.disk.forget(path)
+        self.cache_evicted(path)
+
+    # the Accept-Encoding of the request allows gzip
+    def accepts_gzip(self, header):
+        value = self.request_field(header, 'accept-encoding')
+        if value is None:
+            return False
+        accepted = {}
+        for coding in value.lower().split(','):
+            name, _, params = coding.partition(';')
+            q = 1.0
+            for param in params.split(';'):
+                key, _, number = param.partition('=')
+                if key.strip() == 'q':
+                    try:
+                        q = float(number)
+                    except ValueError:
+                        q = 0.0
+            accepted[name.strip()] = q
+        return accepted.get('gzip', accepted.get('x-gzip', accepted.get('*', 0.0))) > 0
+
+    # the gzip variant of a whole cached response: the body compressed, the
+    # header with Content-Encoding, Content-Length, Vary and ETag changed
+    # returns None if the response is not compressed (not text, already
+    # encoded, too small...), re itself if compressing it does not pay
+    def gzip_response(self, re):
+        received = ResponseLength()
+        received.feed(re)
+        if not received.compressible() or received.chunked or not received.complete() \
+                or received.body_length() < self.gzip_min_size:
+            return None
+        # wbits 16 + MAX_WBITS: the deflate data in a gzip header and trailer
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(bytes(re[received.header_end:])) + compressor.flush()
+        if len(body) >= received.body_length():
+            return re
+        lines = bytes(received.head[:received.header_end - 4]).split(b'\r\n')
+        head = [lines[0]]
+        vary = False
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            value = value.strip()
+            if name == b'content-length':
+                continue
+            if name == b'etag' and value.endswith(b'"'):
+                # another representation, another entity tag
+                line = b'ETag: ' + value[:-1] + b'-gzip"'
+            elif name == b'vary':
+                vary = True
+                if value != b'*' and b'accept-encoding' not in value.lower():
+                    line = b'Vary: ' + value + b', Accept-Encoding'
+            head.append(line)
+        if not vary:
+            head.append(b'Vary: Accept-Encoding')
+        head.append(b'Content-Encoding: gzip')
+        head.append(b'Content-Length: %d' % len(body))
+        return b'\r\n'.join(head) + b'\r\n\r\n' + body
+
+    # write the gzip variant of a cache file as a cache file of its own
+    def store_variant(self, cache_dir, variant, expires):
+        path = self.variant_path(cache_dir)
+        try:
+            url = self.read_meta(cache_dir)['url']
+        except (IOError, OSError, ValueError, KeyError):
+            url = None
+        received = ResponseLength()
+        received.feed(variant)
+        f, temp_dir = self.open_temp_file(path)
+        with f:
+            f.write(variant)
+        # as old as the response it was made from, both go stale together
+        mtime = expires - self.freshness_lifetime(received.fields)
+        os.utime(temp_dir, (mtime, mtime))
+        self.commit_cache_file(temp_dir, path, True, url, received)
+        self.disk.touch(path, expires)
+
+    # a fresh cached response (re, whole) hit by a client accepting gzip:
+    # make its gzip variant once, keep it in memory and on disk
+    # returns what to send, the variant or re if there is none
+    def compress_hit(self, cache_dir, re, expires):
+        variant = self.gzip_response(re)
+        if variant is None or variant is re:
+            # not compressed, so it is not tried again
+            self.no_variant(cache_dir, expires)
+            return re
+        try:
+            self.store_variant(cache_dir, variant, expires)
+        except (IOError, OSError) as e:
+            self.write_log(self.getTimeStamp() + '   Error: cannot store gzip variant ' + str(e), ERROR)
+        self.memory.put(self.variant_path(cache_dir), variant, expires)
+        return variant
+
+    # remember that the cached response has no gzip variant until it
+    # expires: an empty variant in memory (dropped with drop_variant)
+    def no_variant(self, cache_dir, expires):
+        self.memory.put(self.variant_path(cache_dir), b'', expires)
+
+    # the gzip variant of a cached response from its cache file, None if
+    # there is none or it is stale (it is made again from the response)
+    def cached_variant(self, cache_dir):
+        path = self.variant_path(cache_dir)
+        f, mtime, size = self.open_cache_file(path)
+        if f is None:
+            return None
+        with f:
+            variant = f.read()
+        expires = mtime + self.freshness_lifetime(self.response_fields(variant))
+        if expires <= time.time():
+            return None
+        self.disk.touch(path, expires)
+        self.memory.put(path, variant, expires)
+        return variant
+
+    # a 304 Not Modified: the cached response is fresh again from now on
+    # (its age is counted from the cache file's mtime), and the end-to-end
+    # headers of the 304 (Date, Expires, Cache-Control, ETag...) replace the
+    # stored ones; if that changes the header the cache file is written
+    # again with it, its metadata updated and the copies in memory (and
+    # the gzip variant) dropped
+    # head: the header of the 304
+    def refresh_cache_file(self, cache_dir, head):
+        try:
+            f = open(cache_dir, 'rb')
+        except IOError:
+            # removed by the evictor meanwhile
+            return
+        with f:
+            stored = self.read_cached_head(f)
+            new = self.merge_not_modified(stored, head) if stored is not None else None
+            if new is None or new == stored:
+                try:
+                    os.utime(cache_dir, None)
+                except OSError:
+                    pass
+                return
+            out, temp_dir = self.open_temp_file(cache_dir)
+            with out:
+                out.write(new)
+                f.seek(len(stored))
+                shutil.copyfileobj(f, out, self.recv_size)
+        try:
+            meta = self.read_meta(cache_dir)
+            if 'head' in meta:
+                meta['head'] = new.decode('latin-1')
+                meta['body_offset'] = len(new)
+            self.write_meta(cache_dir, meta)
+        except (IOError, OSError, ValueError):
+            # no metadata to update, the cache file is not kept without it
+            os.remove(temp_dir)
+            return
+        self.commit_cache_file(temp_dir, cache_dir, True)
+
+    # the header of a cache file (f at its start), None if it has no
+    # complete header; only read up to the end of the header
+    def read_cached_head(self, f):
+        received = ResponseLength()
+        head = bytearray()
+        while received.header_end == -1 and len(head) < received.max_head:
+            chunk = f.read(min(4096, received.max_head - len(head)))
+            if not chunk:
+                return None
+            head += chunk
+            received.feed(chunk)
+        if received.header_end == -1:
+            return None
+        return bytes(head[:received.header_end])
+
+    # the stored header with the headers of a 304 in place of its own
+    # (the framing and hop-by-hop headers of the 304 are not taken)
+    def merge_not_modified(self, stored, not_modified):
+        skip = (b'connection', b'keep-alive', b'proxy-connection', b'transfer-encoding', b'content-length',
+                b'te', b'trailer', b'upgrade')
+        new = [line for line in not_modified[:-4].split(b'\r\n')[1:]
+               if line.partition(b':')[0].strip().lower() not in skip]
+        names = set(line.partition(b':')[0].strip().lower() for line in new)
+        lines = stored[:-4].split(b'\r\n')
+        kept = [line for line in lines[1:] if line.partition(b':')[0].strip().lower() not in names]
+        return b'\r\n'.join([lines[0]] + kept + new) + b'\r\n\r\n'
+
+    # the cache file f was opened from has been replaced since
+    def cache_file_replaced(self, cache_dir, f):
+        try:
+            return os.stat(cache_dir).st_ino != os.fstat(f.fileno()).st_ino
+        except OSError:
+            return False
+
+    # the cached response is stale: ask the remote server if it changed
+    # returns None if it did not (304), otherwise the new response is
+    # relayed and cached like a miss and fetch_response's result returned
+    def revalidate(self, webserver, port, conn, header, cache_dir, fields, keep_alive):
+        h = self.upstream_request(header, self.conditional_lines(fields))
+        self.write_log('Request-Server-From-Proxy\n'+h, DEBUG)
+        s, first, received = self.request_upstream(webserver, port, h)
+        if received.status == 304 and received.done():
+            self.release_upstream(webserver, port, s, received)
+            self.refresh_cache_file(cache_dir, bytes(first[:received.header_end]))
+            timer = self.timer()
+            timer.cache = 'revalidated'
+            timer.bytes_in += received.length
+            return None
+        return self.fetch_response(webserver, port, conn, header, cache_dir, keep_alive, s, first)
+
+    # a cache miss: get the response from the remote server and cache it
+    # s, first: the connection and the start of the response, if the
+    # request was already sent
+    # download: the Download to write, from join_download
+    # returns the response and None, or None and the ClientResponse
+    # of a response already relayed to the client
+    def fetch_response(self, webserver, port, conn, header, cache_dir, keep_alive, s=None, first=None, download=None):
+        if s is None:
+            h = self.upstream_request(header)
+            self.write_log('Request-Server-From-Proxy\n'+h, DEBUG)
+            s, first = self.request_upstream(webserver, port, h)[:2]
+        if self.stream_relay:
+            # send every chunk to the client as soon as it arrives
+            # the response is already sent when this returns
+            return None, self.relay_response(webserver, port, s, conn, cache_dir, keep_alive, first, download,
+                                             self.cache_url(webserver, header), self.client_chunked(header))
+        #re = s.recv(65536)
+        try:
+            re, received = self.recv_response(s, first)
+        except:
+            s.close()
+            raise
+        self.release_upstream(webserver, port, s, received)
+        t = monotonic()
+        if download is None:
+            f, temp_dir = self.open_temp_file(cache_dir)
+        else:
+            f, temp_dir = download.file, download.temp_dir
+        writer = CacheWriter(f, download)
+        with f:
+            writer.write(re)
+        self.end_download(cache_dir, download, received.complete())
+        self.commit_cache_file(temp_dir, cache_dir, received.complete() and self.cacheable(received),
+                               self.cache_url(webserver, header), writer.stored)
+        self.timer().lap('disk_write', t)
+        return re, None
+
+    # a HEAD request the cache cannot answer goes to the remote server as it
+    # is, the response has no body and is not cached
+    # returns the ClientResponse
+    def head_proxy(self, webserver, port, conn, header, keep_alive=False):
+        h = self.upstream_request(header)
+        self.write_log('Request-Server-From-Proxy\n'+h, DEBUG)
+        s, data, received = self.request_upstream(webserver, port, h, True)
+        self.release_upstream(webserver, port, s, received)
+        timer = self.timer()
+        timer.cache = 'pass'
+        timer.bytes_in += received.length
+        sent = ClientResponse(keep_alive, True)
+        t = monotonic()
+        conn.sendall(sent.feed(data) + sent.flush())
+        timer.lap('client', t)
+        return sent
+
+    # a Range request: the ranges are sent from the cache file if the
+    # response is cached, a request for a response that is not cached goes
+    # to the remote server with its Range (the 206 is not cached) and the
+    # whole response is fetched in the background
+    # returns the ClientResponse, None if the whole response has to be sent
+    def range_proxy(self, webserver, port, conn, header, cache_dir, keep_alive=False):
+        timer = self.timer()
+        t = monotonic()
+        cached, plan = self.range_plan(cache_dir, header)
+        t = timer.lap('disk_read', t)
+        if plan is not None:
+            self.write_log(self.getTimeStamp() + '   Range from cache ' + os.path.basename(cache_dir))
+            timer.cache = 'hit'
+            sent = self.send_parts(conn, *plan, keep_alive=keep_alive)
+            timer.lap('client', t)
+            return sent
+        if cached:
+            return None
+        timer.cache = 'miss'
+        self.get_cache_dir(webserver, header)
+        # not a download other requests join, its response may be a 206
+        re, sent = self.fetch_response(webserver, port, conn, header, cache_dir, keep_alive)
+        if sent is None:
+            sent = self.send_response(conn, re, keep_alive, self.client_chunked(header))
+        if self.range_fill and sent.received.status == 206:
+            start_new_thread(self.fill_cache, (webserver, port, header, cache_dir))
+        return sent
+
+    # the request without its Range / If-Range headers
+    def without_range(self, header):
+        return [header[0]] + [line for line in header[1:]
+                              if line.partition(':')[0].strip().lower() not in ('range', 'if-range')]
+
+    # fetch the whole response into the cache without a client, run in the
+    # background after a Range request; does nothing if it is already
+    # being downloaded
+    def fill_cache(self, webserver, port, header, cache_dir):
+        download, f = self.join_download(cache_dir)
+        if f is not None:
+            f.close()
+            return
+        try:
+            h = self.upstream_request(self.without_range(header))
+            s, first = self.request_upstream(webserver, port, h)[:2]
+            writer = CacheWriter(download.file, download)
+            received = writer.received
+            source = self.recv_chunks(s)
+            try:
+                with download.file:
+                    for chunk in itertools.chain([first], source):
+                        writer.write(chunk)
+                        if received.done():
+                            break
+            finally:
+                source.close()
+                if received.complete():
+                    self.release_upstream(webserver, port, s, received)
+                else:
+                    s.close()
+            self.end_download(cache_dir, download, received.complete())
+            self.commit_cache_file(download.temp_dir, cache_dir, received.complete() and self.cacheable(received),
+                                   self.cache_url(webserver, header), writer.stored)
+            self.write_log(self.getTimeStamp() + '   Filled cache ' + os.path.basename(cache_dir))
+        except Exception as e:
+            self.write_log(self.getTimeStamp() + '   Error: cannot fill cache ' + str(e), ERROR)
+        finally:
+            self.finish_download(cache_dir, download)
+
+    # returns the response and None, or None and the ClientResponse
+    # of a response already relayed to the client
+    # revalidated: the cache file was just revalidated, it is not again
+    def check_cache(self, webserver, port,conn, header, keep_alive=False, revalidated=False):
         # check if there is a cache file
         # if exists : send it back (#check if is up-to-date)
         # not exists: remote request, send it back, cache (cache after send for efficiency)
-        dir = os.path.join(os.getcwd(), 'cache')
-        if not os.path.exists(dir):
-            os.mkdir('cache')
-        dir = os.path.join(dir, webserver)
-        if not os.path.exists(dir):
-            os.mkdir(dir)
-        
-        filename = header[0].split(' ')[1]
-        filename = filename.replace('/','_')
-        filename = filename.replace('?','~')
-        filename = filename.replace(':','_~_')
-        filename += '.cache'
-        
-        
-        print('FILENAME',filename)
-        cache_dir = os.path.join(dir, filename)
-        # cache_status
-        # Ture: cached      False: not cached
-        cache_status = os.path.exists(cache_dir)
+        # a hot response is in memory, served without touching the disk
+        key = self.cache_path(webserver, header)
+        timer = self.timer()
+        # HEAD and conditional requests are answered from the metadata file
+        method = header.method
+        if self.meta_request(method, header):
+            t = monotonic()
+            answer = self.meta_response(key, method, header, keep_alive)
+            t = timer.lap('disk_read', t)
+            if answer is not None:
+                sent, out = answer
+                self.write_log(self.getTimeStamp() + '   Answered from cache metadata ' + str(sent.received.status))
+                timer.cache = 'hit'
+                conn.sendall(out)
+                timer.lap('client', t)
+                return None, sent
+            if method == 'HEAD':
+                return None, self.head_proxy(webserver, port, conn, header, keep_alive)
+        if method == 'GET' and self.request_field(header, 'range') is not None:
+            sent = self.range_proxy(webserver, port, conn, header, key, keep_alive)
+            if sent is not None:
+                return None, sent
+        # a client accepting gzip gets the gzip variant of a text response
+        gzip = method == 'GET' and self.gzip_level and self.accepts_gzip(header)
+        if gzip:
+            re = self.memory.peek(self.variant_path(key))
+            if re is None:
+                t = monotonic()
+                re = self.cached_variant(key)
+                timer.lap('disk_read', t)
+            if re:
+                self.write_log(self.getTimeStamp() + '   Hit gzip variant')
+                timer.cache = 'hit'
+                return re, None
+            # empty: the response has no gzip variant
+            gzip = re is None
+        entry = self.memory.get_entry(key)
+        if entry is not None:
+            re, expires = entry
+            self.disk.touch(key)
+            self.write_log(self.getTimeStamp() + '   Hit Memory Cache!')
+            timer.cache = 'hit'
+            if gzip:
+                re = self.compress_hit(key, re, expires)
+            return re, None
+        cache_dir = key
+        filename = os.path.basename(cache_dir)
+        # None: not cached (or just removed by the evictor)
+        t = monotonic()
+        f, mtime, size = self.open_cache_file(cache_dir)
+        t = timer.lap('disk_read', t)
         # no cache found, retrieve remotely
-        if not cache_status:
+        if f is None:
             # cache and return
-            print(self.getTimeStamp() + '   No cache found')
             self.write_log(self.getTimeStamp() + '   No cache found')
-            h = ''
-            for line in header[:-1]: # the last line is a black line
-                if (not 'Connection' in line) and (not 'Upgrade-Insecure-Requests' in line):
-                    h  += line + '\r\n'
-            h += 'Connection: close\r\n\r\n'
-            print('Request-Server-From-Proxy\n')
-            print(h)
-            self.write_log('Request-Server-From-Proxy\n'+h)
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((webserver, 80))
-            s.sendall(h)
-            #re = s.recv(65536)
-            re = self.recv_all(s)
-            # change to wb+
-            with open(cache_dir,'wb+') as f: 
-                f.write(re)
-            return re
+            timer.cache = 'miss'
+            # the cache directories
+            self.get_cache_dir(webserver, header)
+            # concurrent misses of the same url share one download
+            download, f = self.join_download(cache_dir)
+            if f is not None:
+                self.write_log(self.getTimeStamp() + '   Joined download ' + filename)
+                timer.cache = 'joined'
+                t = monotonic()
+                sent = self.follow_download(download, f, conn, keep_alive, self.client_chunked(header))
+                timer.lap('client', t)
+                if sent is not None:
+                    return None, sent
+                timer.cache = 'miss'
+                return self.fetch_response(webserver, port, conn, header, cache_dir, keep_alive)
+            try:
+                return self.fetch_response(webserver, port, conn, header, cache_dir, keep_alive, download=download)
+            finally:
+                self.finish_download(cache_dir, download)
         else:
             # hit a cache
             re = ''
-            print(self.getTimeStamp() + '   Hit Cache!' + filename)
             self.write_log(self.getTimeStamp() + '   Hit Cache!' + filename)
-            with open(cache_dir,'rb') as f:
-                re = f.read()
-            return re
+            timer.cache = 'hit'
+            with f:
+                # a response too big for the memory cache is sent from the
+                # file, only its first chunk (with the header) is read here
+                big = size > self.memory.max_object
+                re = f.read(self.recv_size if big else -1)
+                timer.lap('disk_read', t)
+                fields = self.response_fields(re)
+                lifetime = self.freshness_lifetime(fields)
+                if not revalidated and time.time() - mtime >= lifetime:
+                    self.write_log(self.getTimeStamp() + '   Cache is stale, revalidating')
+                    fetched = self.revalidate(webserver, port, conn, header, cache_dir, fields, keep_alive)
+                    if fetched is not None:
+                        timer.cache = 'miss'
+                        return fetched
+                    self.write_log(self.getTimeStamp() + '   Not Modified')
+                    if self.cache_file_replaced(cache_dir, f):
+                        # the 304 changed the stored header, sent from the new cache file
+                        fetched = self.check_cache(webserver, port, conn, header, keep_alive, True)
+                        timer.cache = 'revalidated'
+                        return fetched
+                    mtime = time.time()
+                self.disk.touch(cache_dir, mtime + lifetime)
+                if big:
+                    if gzip:
+                        # too big for a gzip variant
+                        self.no_variant(cache_dir, mtime + lifetime)
+                    t = monotonic()
+                    sent = self.send_cached(conn, f, re, size, keep_alive, self.client_chunked(header))
+                    timer.lap('client', t)
+                    return None, sent
+            # only responses hit at least once go to memory, so a response
+            # requested once does not push the hot ones out
+            self.memory.put(cache_dir, re, mtime + lifetime)
+            if gzip:
+                re = self.compress_hit(cache_dir, re, mtime + lifetime)
+            return re, None
             
 
 
             
 
     
-    def http_proxy(self,webserver, port, conn, header):
+    # returns True if the client connection can serve another request
+    def http_proxy(self,webserver, port, conn, header, keep_alive=False):
         #h = ''
         #for line in header[:-1]: # the last line is a black line
         #    if (not 'Connection' in line) and (not 'Upgrade-Insecure-Requests' in line):
@@ -262,13 +3910,18 @@ class Server:
           #re = s.recv(65536)
         #re = self.recv_all(s)
 
-        re = self.check_cache(webserver, port, conn, header)
+        re, sent = self.check_cache(webserver, port, conn, header, keep_alive)
 
-        # debug: it seems good, retrieved the page successfully :)
-        self.write_log(self.getTimeStamp() + 'GET_The_response\n####\n' + re)
-        
-        conn.sendall(re)
-        conn.close()
+        # sent: the response was streamed to the client by relay_response
+        if sent is None:
+            # debug: it seems good, retrieved the page successfully :)
+            if self.logger.enabled(DEBUG):
+                self.write_log(self.getTimeStamp() + 'GET_The_response\n####\n' + re, DEBUG)
+            t = monotonic()
+            sent = self.send_response(conn, re, keep_alive, self.client_chunked(header))
+            self.timer().lap('client', t)
+        self.timer().bytes_out += sent.received.length
+        return sent.keep()
 
         
 
@@ -287,12 +3940,727 @@ class Server:
 
         #conn.close()
 
+    # event mode: serve every connection from one event loop
+    # blocking disk I/O and name lookups run in a small thread pool
+    def listen_event(self, max_conn):
+        # a deeper backlog, accepting is cheap in this mode
+        self.create_listen_socket(max(max_conn, socket.SOMAXCONN))
+        self.listen_socket.setblocking(0)
+        self.pool = ThreadPool(self.pool_workers)
+        # a client or server silent for client_timeout seconds is closed
+        self.loop = EventLoop(self.pool, self.client_timeout)
+        self.tunnel_loop = self.loop
+        # the request timers of this thread are on the loop's tasks
+        self.local.loop = self.loop
+        self.loop.spawn(self.accept_event())
+        self.loop.run_forever()
+
+    def accept_event(self):
+        last_log = 0
+        while True:
+            try:
+                conn, addr = yield ('accept', self.listen_socket)
+            except socket.error as e:
+                # e.g. out of file descriptors, keep serving the open connections
+                # log at most once a second, the error repeats until fds are freed
+                if time.time() - last_log > 1:
+                    last_log = time.time()
+                    self.write_log(self.getTimeStamp() + '   Error: Fail to accept client...'+str(e), ERROR)
+                if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # the listen socket stays readable, stop accepting for a while
+                    # instead of spinning on it
+                    yield ('sleep', self.accept_backoff)
+                continue
+            self.loop.spawn(self.read_request_event(conn, addr))
+
+    # event mode version of read_request
+    # a pooled buffer is only held while a request header is read, the bytes
+    # of a pipelined request after it are kept in rest
+    def read_request_event(self, conn, addr):
+        # the task serving the connection, it holds the timer of its request
+        task = self.loop.current
+        rest = b''
+        served = 0
+        # the first request waits the loop's client_timeout
+        timeout = None
+        try:
+            while served < self.max_requests:
+                if not rest:
+                    # an idle connection holds no buffer, one is taken
+                    # when its next request arrives
+                    yield ('readable', conn, timeout)
+                buf = self.buffers.acquire()
+                view = memoryview(buf)
+                try:
+                    buf[:len(rest)] = rest
+                    end = len(rest)
+                    parser = RequestParser()
+                    # read into the pooled buffer until the end of the header
+                    while not parser.feed(buf, end):
+                        if end == len(buf):
+                            raise ValueError('request header too long')
+                        n = yield ('recv_into', conn, view[end:], timeout)
+                        if n == 0:
+                            if end:
+                                raise ValueError('connection closed in the request header')
+                            return
+                        end += n
+                    length = parser.length
+                    timer = task.timer = RequestTimer()
+                    header = parser.parse()
+                    method, path, version, webserver, port = \
+                        header.method, header.target, header.version, header.host, header.port
+                    timer.lap('parse', timer.started)
+                    rest = bytes(buf[length:end])
+                finally:
+                    self.buffers.release(buf)
+                served += 1
+                keep_alive = served < self.max_requests and self.wants_keep_alive(version, header)
+                if self.logger.enabled(DEBUG):
+                    self.write_log('\n'.join(line for line in header), DEBUG)
+                    self.write_log('     webserver: {}   port: {}'.format(webserver, port), DEBUG)
+
+                try:
+                    stats = self.stats_response(method, webserver, header, keep_alive)
+                    if stats is not None:
+                        timer.internal = True
+                        yield ('sendall', conn, stats)
+                        if not keep_alive:
+                            return
+                    elif method == b'CONNECT':
+                        self.write_log(self.getTimeStamp() + '   HTTPS CONNECT Request')
+                        yield self.https_proxy_event(webserver, port, conn, header, rest)
+                        return
+                    elif method in (b'GET', b'HEAD'):
+                        self.write_log(self.getTimeStamp()+'     HTTP ' + method + ' Request')
+                        try:
+                            sent = yield self.http_proxy_event(webserver, port, conn, header, keep_alive)
+                        except UpstreamError as e:
+                            yield ('sendall', conn, self.upstream_down(webserver, e))
+                            return
+                        timer.bytes_out += sent.received.length
+                        if not sent.keep():
+                            return
+                    else:
+                        self.write_log(self.getTimeStamp()+'    Unexpected Request method')
+                        return
+                except Exception as e:
+                    timer.cache = 'error'
+                    raise e
+                finally:
+                    task.timer = None
+                    self.metrics.record(timer)
+                timeout = self.keep_alive_timeout
+        except socket.timeout:
+            self.write_log(self.getTimeStamp()+'     Timeout, closing the connection')
+        except Exception as e:
+            self.write_log(self.getTimeStamp()+'     Error: cannot read quest '+ str(e)+'\n', ERROR)
+        finally:
+            conn.close()
+
+    # open the cache file, returns it, its mtime (when it was received
+    # or last revalidated) and its size, None, None, None if there is no
+    # cache for the request
+    def open_cache_file(self, cache_dir):
+        if self.disk.lookup(cache_dir) is False:
+            # not in the index, a miss without a system call
+            return None, None, None
+        try:
+            f = open(cache_dir, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                self.disk.forget(cache_dir)
+                return None, None, None
+            raise
+        self.disk.touch(cache_dir)
+        st = os.fstat(f.fileno())
+        return f, st.st_mtime, st.st_size
+
+    # event mode version of check_cache + http_proxy
+    # ends with ('return', ClientResponse)
+    def http_proxy_event(self, webserver, port, conn, header, keep_alive=False, revalidated=False):
+        key = self.cache_path(webserver, header)
+        timer = self.timer()
+        method = header.method
+        chunked = self.client_chunked(header)
+        if self.meta_request(method, header):
+            t = monotonic()
+            answer = yield ('call', self.meta_response, (key, method, header, keep_alive))
+            t = timer.lap('disk_read', t)
+            if answer is not None:
+                sent, out = answer
+                self.write_log(self.getTimeStamp() + '   Answered from cache metadata ' + str(sent.received.status))
+                timer.cache = 'hit'
+                yield ('sendall', conn, out)
+                timer.lap('client', t)
+                yield ('return', sent)
+            if method == 'HEAD':
+                sent = yield self.head_proxy_event(webserver, port, conn, header, keep_alive)
+                yield ('return', sent)
+        if method == 'GET' and self.request_field(header, 'range') is not None:
+            t = monotonic()
+            cached, plan = yield ('call', self.range_plan, (key, header))
+            t = timer.lap('disk_read', t)
+            if plan is not None:
+                self.write_log(self.getTimeStamp() + '   Range from cache ' + os.path.basename(key))
+                timer.cache = 'hit'
+                sent = yield self.send_parts_event(conn, keep_alive, *plan)
+                timer.lap('client', t)
+                yield ('return', sent)
+            if not cached:
+                timer.cache = 'miss'
+                sent = yield self.range_miss_event(webserver, port, conn, header, key, keep_alive)
+                yield ('return', sent)
+        gzip = method == 'GET' and self.gzip_level and self.accepts_gzip(header)
+        if gzip:
+            data = self.memory.peek(self.variant_path(key))
+            if data is None and self.disk.lookup(self.variant_path(key)) is not False:
+                t = monotonic()
+                data = yield ('call', self.cached_variant, (key,))
+                timer.lap('disk_read', t)
+            if data:
+                self.write_log(self.getTimeStamp() + '   Hit gzip variant')
+                timer.cache = 'hit'
+                sent = ClientResponse(keep_alive, chunked=chunked, size=len(data))
+                t = monotonic()
+                yield ('sendall', conn, sent.feed(data) + sent.flush())
+                timer.lap('client', t)
+                yield ('return', sent)
+            # empty: the response has no gzip variant
+            gzip = data is None
+        entry = self.memory.get_entry(key)
+        if entry is not None:
+            data, expires = entry
+            self.disk.touch(key)
+            self.write_log(self.getTimeStamp() + '   Hit Memory Cache!')
+            timer.cache = 'hit'
+            if gzip:
+                data = yield ('call', self.compress_hit, (key, data, expires))
+            sent = ClientResponse(keep_alive, chunked=chunked, size=len(data))
+            t = monotonic()
+            yield ('sendall', conn, sent.feed(data) + sent.flush())
+            timer.lap('client', t)
+            yield ('return', sent)
+        cache_dir = key
+        if self.disk.lookup(cache_dir) is False:
+            # not in the index, no need to ask the thread pool
+            f, mtime, size = None, None, None
+        else:
+            t = monotonic()
+            f, mtime, size = yield ('call', self.open_cache_file, (cache_dir,))
+            timer.lap('disk_read', t)
+        buf = self.buffers.acquire()
+        view = memoryview(buf)
+        try:
+            if f is not None:
+                # hit a cache, send it in chunks so a big file is never read at once
+                self.write_log(self.getTimeStamp() + '   Hit Cache!' + os.path.basename(cache_dir))
+                timer.cache = 'hit'
+                try:
+                    # the first chunk has the header, to see if it is still fresh
+                    t = monotonic()
+                    n = yield ('call', f.readinto, (buf,))
+                    timer.lap('disk_read', t)
+                    fields = self.response_fields(view[:n])
+                    lifetime = self.freshness_lifetime(fields)
+                    upstream = None
+                    replaced = False
+                    if not revalidated and time.time() - mtime >= lifetime:
+                        self.write_log(self.getTimeStamp() + '   Cache is stale, revalidating')
+                        upstream = yield self.revalidate_event(webserver, port, header, cache_dir, fields)
+                        if upstream is None:
+                            replaced = yield ('call', self.cache_file_replaced, (cache_dir, f))
+                        mtime = time.time()
+                except Exception as e:
+                    yield ('call', f.close, ())
+                    raise e
+                if upstream is not None:
+                    # changed, the new response replaces the cache file
+                    timer.cache = 'miss'
+                    yield ('call', f.close, ())
+                    sent = yield self.fetch_event(webserver, port, conn, header, cache_dir, buf, keep_alive, upstream)
+                    yield ('return', sent)
+                if replaced:
+                    # the 304 changed the stored header, sent from the new cache file
+                    yield ('call', f.close, ())
+                    sent = yield self.http_proxy_event(webserver, port, conn, header, keep_alive, True)
+                    timer.cache = 'revalidated'
+                    yield ('return', sent)
+                if gzip and size <= self.memory.max_object:
+                    # the whole response, to send its gzip variant instead
+                    try:
+                        t = monotonic()
+                        data = view[:n].tobytes() + (yield ('call', f.read, ()))
+                        timer.lap('disk_read', t)
+                    except Exception as e:
+                        yield ('call', f.close, ())
+                        raise e
+                    yield ('call', f.close, ())
+                    self.disk.touch(cache_dir, mtime + lifetime)
+                    self.memory.put(cache_dir, data, mtime + lifetime)
+                    data = yield ('call', self.compress_hit, (cache_dir, data, mtime + lifetime))
+                    sent = ClientResponse(keep_alive, chunked=chunked, size=len(data))
+                    t = monotonic()
+                    yield ('sendall', conn, sent.feed(data) + sent.flush())
+                    timer.lap('client', t)
+                    yield ('return', sent)
+                if gzip:
+                    # too big for a gzip variant
+                    self.no_variant(cache_dir, mtime + lifetime)
+                sent = ClientResponse(keep_alive, chunked=chunked, size=size)
+                received = sent.received
+                if size > self.memory.max_object and sendfile is not None:
+                    out = sent.feed(view[:n])
+                    if received.header_end != -1 and not received.chunked:
+                        # too big for the memory cache, the body goes from
+                        # the file to the client with sendfile
+                        try:
+                            t = monotonic()
+                            if out:
+                                yield ('sendall', conn, out)
+                            yield ('sendfile', conn, f.fileno(), n, size - n)
+                            timer.lap('client', t)
+                        except Exception as e:
+                            yield ('call', f.close, ())
+                            raise e
+                        sent.skip(size - n)
+                        yield ('call', f.close, ())
+                        self.disk.touch(cache_dir, mtime + lifetime)
+                        yield ('return', sent)
+                    sent = ClientResponse(keep_alive, chunked=chunked, size=size)
+                # the whole file, for the memory cache if it is small enough
+                data = bytearray()
+                try:
+                    while n:
+                        if data is not None:
+                            data += view[:n]
+                            if len(data) > self.memory.max_object:
+                                data = None
+                        out = sent.feed(view[:n])
+                        t = monotonic()
+                        if out:
+                            yield ('sendall', conn, out)
+                            t = timer.lap('client', t)
+                        n = yield ('call', f.readinto, (buf,))
+                        timer.lap('disk_read', t)
+                    out = sent.flush()
+                    if out:
+                        t = monotonic()
+                        yield ('sendall', conn, out)
+                        timer.lap('client', t)
+                except Exception as e:
+                    yield ('call', f.close, ())
+                    raise e
+                yield ('call', f.close, ())
+                self.disk.touch(cache_dir, mtime + lifetime)
+                if data is not None:
+                    self.memory.put(cache_dir, data, mtime + lifetime)
+                yield ('return', sent)
+            # concurrent misses of the same url share one download
+            timer.cache = 'miss'
+            yield ('call', self.get_cache_dir, (webserver, header))
+            download, f = yield ('call', self.join_download, (cache_dir,))
+            if f is not None:
+                self.write_log(self.getTimeStamp() + '   Joined download ' + os.path.basename(cache_dir))
+                timer.cache = 'joined'
+                t = monotonic()
+                sent = yield self.follow_download_event(download, f, conn, buf, keep_alive, chunked)
+                timer.lap('client', t)
+                if sent is None:
+                    timer.cache = 'miss'
+                    sent = yield self.fetch_event(webserver, port, conn, header, cache_dir, buf, keep_alive)
+                yield ('return', sent)
+            try:
+                sent = yield self.fetch_event(webserver, port, conn, header, cache_dir, buf, keep_alive,
+                                              download=download)
+            except Exception as e:
+                yield ('call', self.finish_download, (cache_dir, download))
+                raise e
+            yield ('call', self.finish_download, (cache_dir, download))
+            yield ('return', sent)
+        finally:
+            self.buffers.release(buf)
+
+    # event mode version of send_parts, ends with ('return', ClientResponse)
+    def send_parts_event(self, conn, keep_alive, f, head, parts, trailer):
+        sent = ClientResponse(keep_alive)
+        buf = None
+        try:
+            yield ('sendall', conn, sent.feed(head))
+            for prefix, offset, count in parts:
+                if prefix:
+                    yield ('sendall', conn, sent.feed(prefix))
+                if sendfile is not None:
+                    yield ('sendfile', conn, f.fileno(), offset, count)
+                    sent.skip(count)
+                    continue
+                if buf is None:
+                    buf = self.buffers.acquire()
+                view = memoryview(buf)
+                yield ('call', f.seek, (offset,))
+                left = count
+                while left:
+                    n = yield ('call', f.readinto, (view[:min(len(buf), left)],))
+                    if not n:
+                        break
+                    yield ('sendall', conn, view[:n])
+                    sent.skip(n)
+                    left -= n
+            if trailer:
+                yield ('sendall', conn, sent.feed(trailer))
+        except Exception as e:
+            yield ('call', f.close, ())
+            raise e
+        finally:
+            if buf is not None:
+                self.buffers.release(buf)
+        yield ('call', f.close, ())
+        yield ('return', sent)
+
+    # event mode version of the miss path of range_proxy
+    # ends with ('return', ClientResponse)
+    def range_miss_event(self, webserver, port, conn, header, cache_dir, keep_alive=False):
+        yield ('call', self.get_cache_dir, (webserver, header))
+        buf = self.buffers.acquire()
+        try:
+            # not a download other requests join, its response may be a 206
+            sent = yield self.fetch_event(webserver, port, conn, header, cache_dir, buf, keep_alive)
+        finally:
+            self.buffers.release(buf)
+        if self.range_fill and sent.received.status == 206:
+            self.loop.spawn(self.fill_event(webserver, port, header, cache_dir))
+        yield ('return', sent)
+
+    # event mode version of fill_cache
+    def fill_event(self, webserver, port, header, cache_dir):
+        download, f = yield ('call', self.join_download, (cache_dir,))
+        if f is not None:
+            yield ('call', f.close, ())
+            return
+        buf = self.buffers.acquire()
+        view = memoryview(buf)
+        try:
+            h = self.upstream_request(self.without_range(header))
+            s, first = (yield self.request_upstream_event(webserver, port, h))[:2]
+            writer = CacheWriter(download.file, download)
+            received = writer.received
+            try:
+                yield ('call', writer.write, (first,))
+                while not received.done():
+                    n = yield ('recv_into', s, view)
+                    if n == 0:
+                        break
+                    yield ('call', writer.write, (view[:n],))
+            except Exception as e:
+                s.close()
+                raise e
+            if received.complete():
+                self.release_upstream(webserver, port, s, received)
+            else:
+                s.close()
+            yield ('call', download.file.close, ())
+            self.end_download(cache_dir, download, received.complete())
+            yield ('call', self.commit_cache_file, (download.temp_dir, cache_dir,
+                                                    received.complete() and self.cacheable(received),
+                                                    self.cache_url(webserver, header), writer.stored))
+            self.write_log(self.getTimeStamp() + '   Filled cache ' + os.path.basename(cache_dir))
+        except Exception as e:
+            self.write_log(self.getTimeStamp() + '   Error: cannot fill cache ' + str(e), ERROR)
+        self.buffers.release(buf)
+        yield ('call', self.finish_download, (cache_dir, download))
+
+    # event mode version of follow_download
+    # ends with ('return', ClientResponse), or ('return', None) if the
+    # download failed before the header was sent
+    def follow_download_event(self, download, f, conn, buf, keep_alive, chunked=False):
+        sent = ClientResponse(keep_alive, chunked=chunked)
+        view = memoryview(buf)
+        pos = 0
+        try:
+            while True:
+                written, done = yield ('callback', download.subscribe, (pos,))
+                if written == pos:
+                    break
+                n = yield ('call', f.readinto, (view[:min(len(buf), written - pos)],))
+                if not n:
+                    break
+                pos += n
+                out = sent.feed(view[:n])
+                if out:
+                    yield ('sendall', conn, out)
+        except Exception as e:
+            self.leave_download(download)
+            yield ('call', f.close, ())
+            raise e
+        self.leave_download(download)
+        yield ('call', f.close, ())
+        if not sent.head_sent:
+            yield ('return', None)
+        out = sent.flush(download.complete)
+        if out:
+            yield ('sendall', conn, out)
+        yield ('return', sent)
+
+    # event mode version of request_upstream
+    # ends with ('return', (socket, start of the response, ResponseLength))
+    def request_upstream_event(self, webserver, port, h, head_request=False):
+        s, reused = yield self.send_upstream_event(webserver, port, h)
+        first, received = yield self.recv_head_event(s, webserver, port, head_request, reused)
+        if reused and not first:
+            s.close()
+            self.write_log(self.getTimeStamp() + '   Pooled connection closed by the server, retrying', DEBUG)
+            s = (yield self.send_upstream_event(webserver, port, h, False))[0]
+            first, received = yield self.recv_head_event(s, webserver, port, head_request)
+        yield ('return', (s, first, received))
+
+    # event mode version of send_upstream
+    # ends with ('return', (socket, True if it came from the pool))
+    def send_upstream_event(self, webserver, port, h, pooled=True):
+        s = None
+        if pooled:
+            self.check_upstream(webserver, port)
+            if self.upstream_keep_alive:
+                s = self.upstreams.get((webserver, port))
+        if s is not None:
+            try:
+                yield ('sendall', s, h)
+                self.timer().upstream = 'reused'
+                yield ('return', (s, True))
+            except socket.error:
+                s.close()
+        s = yield self.connect_event(webserver, port)
+        try:
+            yield ('sendall', s, h)
+        except socket.error as e:
+            s.close()
+            raise self.upstream_failed(webserver, port, e)
+        except Exception as e:
+            s.close()
+            raise e
+        yield ('return', (s, False))
+
+    # a new connection to the remote server, ends with ('return', socket)
+    def connect_event(self, webserver, port):
+        timer = self.timer()
+        t = monotonic()
+        # only a name not cached is looked up in the pool
+        try:
+            address = self.resolver.get(webserver)
+            if address is None:
+                address = yield ('call', self.resolver.fetch, (webserver,))
+        except socket.error as e:
+            raise self.upstream_failed(webserver, port, e)
+        t = timer.lap('dns', t)
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(0)
+        try:
+            yield ('connect', s, (address, port))
+        except socket.error as e:
+            s.close()
+            raise self.upstream_failed(webserver, port, e)
+        except Exception as e:
+            s.close()
+            raise e
+        timer.lap('connect', t)
+        timer.upstream = 'new'
+        yield ('return', s)
+
+    # event mode version of https_proxy, the tunnel runs as a task of its own
+    def https_proxy_event(self, webserver, port, conn, header, rest=b''):
+        self.timer().cache = 'pass'
+        if not self.connect_allowed(webserver, port):
+            yield ('sendall', conn, self.forbidden_response)
+            return
+        try:
+            self.check_upstream(webserver, port)
+            s = yield self.connect_event(webserver, port)
+        except Exception as e:
+            self.write_log(self.getTimeStamp() + '   Error: cannot connect to ' + webserver + ' ' + str(e), ERROR)
+            yield ('sendall', conn, self.bad_gateway_response)
+            return
+        self.upstream_answered(webserver, port)
+        try:
+            yield ('sendall', conn, b'HTTP/1.1 200 Connection established\r\n\r\n')
+        except Exception as e:
+            s.close()
+            raise e
+        # read_request_event closes conn, the tunnel keeps its own reference
+        self.loop.spawn(self.tunnel_event(self.loop, conn.dup(), s, webserver, port, rest))
+
+    # event mode version of recv_head, s is closed if it fails (but not
+    # when pooled and closed before any byte came, the start is empty)
+    # ends with ('return', (start of the response, ResponseLength))
+    def recv_head_event(self, s, webserver, port, head_request=False, pooled=False):
+        buf = self.buffers.acquire()
+        view = memoryview(buf)
+        first = bytearray()
+        received = ResponseLength(head_request)
+        t = monotonic()
+        try:
+            while received.header_end == -1:
+                n = yield ('recv_into', s, view)
+                if n == 0:
+                    if pooled and not first:
+                        yield ('return', (first, received))
+                    raise UpstreamError('no response from ' + webserver)
+                first += view[:n]
+                received.feed(view[:n])
+        except socket.error as e:
+            if pooled and not first and not isinstance(e, (socket.timeout, UpstreamError)):
+                yield ('return', (first, received))
+            s.close()
+            raise self.upstream_failed(webserver, port, e)
+        except Exception as e:
+            s.close()
+            raise e
+        finally:
+            self.buffers.release(buf)
+        self.timer().lap('upstream', t)
+        self.upstream_answered(webserver, port)
+        yield ('return', (first, received))
+
+    # event mode version of head_proxy, ends with ('return', ClientResponse)
+    def head_proxy_event(self, webserver, port, conn, header, keep_alive=False):
+        h = self.upstream_request(header)
+        self.write_log('Request-Server-From-Proxy\n'+h, DEBUG)
+        s, data, received = yield self.request_upstream_event(webserver, port, h, True)
+        self.release_upstream(webserver, port, s, received)
+        timer = self.timer()
+        timer.cache = 'pass'
+        timer.bytes_in += received.length
+        sent = ClientResponse(keep_alive, True)
+        t = monotonic()
+        yield ('sendall', conn, sent.feed(data) + sent.flush())
+        timer.lap('client', t)
+        yield ('return', sent)
+
+    # event mode version of revalidate
+    # ends with ('return', None) if the cached response did not change (304),
+    # otherwise with ('return', (socket, start of the new response))
+    def revalidate_event(self, webserver, port, header, cache_dir, fields):
+        h = self.upstream_request(header, self.conditional_lines(fields))
+        self.write_log('Request-Server-From-Proxy\n'+h, DEBUG)
+        s, first, received = yield self.request_upstream_event(webserver, port, h)
+        if received.status == 304 and received.done():
+            self.release_upstream(webserver, port, s, received)
+            timer = self.timer()
+            timer.cache = 'revalidated'
+            timer.bytes_in += received.length
+            yield ('call', self.refresh_cache_file, (cache_dir, bytes(first[:received.header_end])))
+            self.write_log(self.getTimeStamp() + '   Not Modified')
+            yield ('return', None)
+        yield ('return', (s, first))
+
+    # a cache miss: get the response from the remote server, send it to the
+    # client and cache it, buf is a pooled buffer to receive into
+    # upstream: (socket, start of the response) if the request was already sent
+    # download: the Download to write, from join_download
+    # ends with ('return', ClientResponse)
+    def fetch_event(self, webserver, port, conn, header, cache_dir, buf, keep_alive=False, upstream=None,
+                    download=None):
+        if upstream is None:
+            self.write_log(self.getTimeStamp() + '   No cache found')
+            h = self.upstream_request(header)
+            self.write_log('Request-Server-From-Proxy\n'+h, DEBUG)
+            s, first = (yield self.request_upstream_event(webserver, port, h))[:2]
+        else:
+            s, first = upstream
+        view = memoryview(buf)
+        sent = ClientResponse(keep_alive, chunked=self.client_chunked(header))
+        received = sent.received
+        # stream_relay False: keep the whole response and send it at the end
+        response = None if self.stream_relay else bytearray()
+        f, temp_dir = None, None
+        # the error of a client that left while other requests follow the
+        # download, as in relay_response
+        gone = None
+        timer = self.timer()
+        try:
+            t = monotonic()
+            if download is None:
+                f, temp_dir = yield ('call', self.open_temp_file, (cache_dir,))
+                t = timer.lap('disk_write', t)
+            else:
+                f, temp_dir = download.file, download.temp_dir
+            writer = CacheWriter(f, download)
+            while True:
+                if first:
+                    chunk = memoryview(first)
+                    first = None
+                else:
+                    n = yield ('recv_into', s, view)
+                    t = timer.lap('upstream', t)
+                    if n == 0:
+                        break
+                    chunk = view[:n]
+                yield ('call', writer.write, (chunk,))
+                t = timer.lap('disk_write', t)
+                out = sent.feed(chunk)
+                if response is not None:
+                    response += out
+                elif gone is not None:
+                    if not self.keep_downloading(cache_dir, download):
+                        raise gone
+                elif out:
+                    gone = yield self.send_or_keep_event(conn, out, cache_dir, download)
+                    t = timer.lap('client', t)
+                if received.done():
+                    break
+            out = sent.flush(received.complete())
+            if response is not None:
+                response += out
+            elif out and gone is None:
+                gone = yield self.send_or_keep_event(conn, out, cache_dir, download)
+                timer.lap('client', t)
+        except Exception as e:
+            timer.bytes_in += received.length
+            s.close()
+            if f is not None:
+                yield ('call', f.close, ())
+                self.end_download(cache_dir, download)
+                yield ('call', self.commit_cache_file, (temp_dir, cache_dir, False))
+            raise e
+        timer.bytes_in += received.length
+        if received.complete():
+            self.release_upstream(webserver, port, s, received)
+        else:
+            s.close()
+        t = monotonic()
+        yield ('call', f.close, ())
+        self.end_download(cache_dir, download, received.complete())
+        yield ('call', self.commit_cache_file, (temp_dir, cache_dir, received.complete() and self.cacheable(received),
+                                                self.cache_url(webserver, header), writer.stored))
+        t = timer.lap('disk_write', t)
+        if gone is not None:
+            raise gone
+        if response is not None:
+            yield ('sendall', conn, response)
+            timer.lap('client', t)
+        self.write_log(self.getTimeStamp() + '   Relayed ' + str(received.length) + ' bytes')
+        yield ('return', sent)
+
+    # event mode version of send_or_keep
+    # ends with ('return', None), or ('return', error) if the client left
+    # and the download goes on for the requests following it
+    def send_or_keep_event(self, conn, out, cache_dir, download):
+        try:
+            yield ('sendall', conn, out)
+        except socket.error as e:
+            if not self.keep_downloading(cache_dir, download):
+                raise e
+            self.write_log(self.getTimeStamp() + '   Client gone, downloading for the joined requests')
+            yield ('return', e)
+        yield ('return', None)
 
 
 
 if __name__ == '__main__':
     if len(sys.argv) <= 1:
-        sys.exit('Usage: python ProxyServer.py [port]')
+        sys.exit('Usage: python ProxyServer.py [port] [threaded|event] [processes]')
     server_address = ('', int(sys.argv[1]))
     server = Server(server_address)
+    if len(sys.argv) > 2:
+        server.serve_mode = sys.argv[2]
+    if len(sys.argv) > 3:
+        server.processes = int(sys.argv[3])
     server.serve_forever()
\ No newline at end of file
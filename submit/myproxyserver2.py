@@ -45,6 +45,18 @@ class Server:
     address_family = socket.AF_INET
     socket_type = socket.SOCK_STREAM
     max_conn = 5
+    # seconds the address of a web server is kept after a lookup,
+    # and a name that could not be found
+    dns_ttl = 300
+    dns_negative_ttl = 10
+    # seconds to wait for the web server
+    upstream_timeout = 30
+    # a web server failing breaker_failures times in a row is not asked for
+    # breaker_backoff seconds, then one request tries it again; every failed
+    # try doubles the wait, up to breaker_max_backoff seconds
+    breaker_failures = 3
+    breaker_backoff = 5
+    breaker_max_backoff = 120
 
     client_page = """
     <html>
@@ -76,6 +88,14 @@ class Server:
         self.server_address = server_address
         self.host = server_address[0]
         self.port = int(server_address[1])
+        # webserver -> (address or the error of the lookup, expires)
+        self.names = {}
+        # webserver -> [failures in a row, down until (0: not down), backoff,
+        # time of the try in progress (0: none)]
+        self.origins = {}
+        # sent when the web server cannot be reached
+        self.bad_connection_response = self.generate_header_lines(404, len(self.page_bad_connection)) \
+            + self.page_bad_connection
 
 
     # Function to get timestamp
@@ -180,14 +200,16 @@ class Server:
 
 
             try:
-                socket.create_connection((webserver,port))
+                # only the name is checked, check_cache makes the connection
+                self.resolve(webserver)
             except socket.error, err:
                 print(self.getTimeStamp() + ' Bad Connection!'+str(err))
                 self.write_log(self.getTimeStamp() + ' Bad Connection!'+str(err))
-                page = self.page_bad_connection
-                header = self.generate_header_lines(404, len(page))
-                conn.sendall(header+page)
-                sys.exit(1)
+                conn.sendall(self.bad_connection_response)
+                # return, not sys.exit(): it would only end this thread and
+                # leave the client connection open
+                conn.close()
+                return
 
             # handle request
             # Is HTTPS CONNECT request
@@ -215,7 +237,8 @@ class Server:
                 # invalid method, log and exit
                 print(self.getTimeStamp()+' Unexpected Request method')
                 self.write_log(self.getTimeStamp()+' Unexpected Request method')
-                sys.exit(1)
+                conn.close()
+                return
 
         except Exception as e:
             print(self.getTimeStamp()+' Error: cannot read quest Error: ' + str(e)+'\n')
@@ -223,6 +246,56 @@ class Server:
             return
 
 
+    # the address of the webserver, looked up once and kept for dns_ttl seconds
+    # a name not found is kept for dns_negative_ttl seconds, its error raised again
+    def resolve(self, webserver):
+        entry = self.names.get(webserver)
+        if entry is None or entry[1] <= time.time():
+            try:
+                entry = (socket.gethostbyname(webserver), time.time() + self.dns_ttl)
+            except socket.error, err:
+                entry = (err, time.time() + self.dns_negative_ttl)
+            self.names[webserver] = entry
+        if isinstance(entry[0], socket.error):
+            raise entry[0]
+        return entry[0]
+
+    # True if the webserver is down and not to be asked now
+    # when its backoff is over one request (the try) is let through
+    def origin_down(self, webserver):
+        state = self.origins.get(webserver)
+        if state is None or state[1] == 0:
+            return False
+        now = time.time()
+        if now < state[1] or now - state[3] < self.upstream_timeout:
+            return True
+        state[3] = now
+        return False
+
+    # the webserver could not be reached or sent nothing
+    def origin_failed(self, webserver):
+        state = self.origins.setdefault(webserver, [0, 0, self.breaker_backoff, 0])
+        if state[1] and not state[3]:
+            # a request sent before it was found down
+            return
+        state[0] += 1
+        if state[0] < self.breaker_failures:
+            return
+        if state[1]:
+            # the try failed
+            state[2] = min(state[2] * 2, self.breaker_max_backoff)
+        state[1] = time.time() + state[2]
+        state[3] = 0
+        print(self.getTimeStamp() + ' Server down: {} for {}s'.format(webserver, state[2]))
+        self.write_log(self.getTimeStamp() + ' Server down: {} for {}s'.format(webserver, state[2]))
+
+    # the webserver answered
+    def origin_answered(self, webserver):
+        state = self.origins.pop(webserver, None)
+        if state is not None and state[1]:
+            print(self.getTimeStamp() + ' Server up again: ' + webserver)
+            self.write_log(self.getTimeStamp() + ' Server up again: ' + webserver)
+
     # generate header for HTTP response from the proxy server
     def generate_header_lines(self, status, length):
         h = ''
@@ -315,11 +388,28 @@ class Server:
             print(self.getTimeStamp() + 'Request the file from the remote server\nRequesting...\nRequest Message\n'+h)
             #self.write_log('Request-Server-From-Proxy\n'+h)
             self.write_log(self.getTimeStamp() + 'Request the file from the remote server\nRequesting...\nRequest Message\n'+h)
+            # a server found down is not asked, the client gets the answer at once
+            if self.origin_down(webserver):
+                print(self.getTimeStamp() + ' Server down, not asked: ' + webserver)
+                self.write_log(self.getTimeStamp() + ' Server down, not asked: ' + webserver)
+                return self.bad_connection_response
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((webserver, 80))
-            s.sendall(h)
-            #re = s.recv(65536)
-            re = self.recv_all(s)
+            s.settimeout(self.upstream_timeout)
+            try:
+                s.connect((self.resolve(webserver), 80))
+                s.sendall(h)
+                #re = s.recv(65536)
+                re = self.recv_all(s)
+            except socket.error, err:
+                print(self.getTimeStamp() + ' Bad Connection!'+str(err))
+                self.write_log(self.getTimeStamp() + ' Bad Connection!'+str(err))
+                re = ''
+            finally:
+                s.close()
+            if not re:
+                self.origin_failed(webserver)
+                return self.bad_connection_response
+            self.origin_answered(webserver)
             # change to wb+
             with open(cache_dir,'wb+') as f:
                 f.write(re)
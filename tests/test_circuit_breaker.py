@@ -0,0 +1,105 @@
+'''
+> Tests of the health tracking of the remote servers (CircuitBreaker): the
+  circuit opening, the half-open probe and the backoff, with a clock moved
+  by hand
+> Usage: python -m unittest discover tests
+'''
+
+import sys, os
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import myProxyServer2
+from myProxyServer2 import CircuitBreaker
+
+
+# the time as CircuitBreaker sees it, moved by the tests
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+KEY = ('origin.test', 80)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.monotonic = myProxyServer2.monotonic
+        myProxyServer2.monotonic = self.clock
+        # opens after 3 failures, for 10 seconds then 20, at most 30
+        self.breaker = CircuitBreaker(3, 10, 30, 5)
+
+    def tearDown(self):
+        myProxyServer2.monotonic = self.monotonic
+
+    def open(self):
+        for i in range(3):
+            self.breaker.allow(KEY)
+            backoff = self.breaker.failure(KEY)
+        return backoff
+
+    def test_opens_after_failures_in_a_row(self):
+        self.assertEqual(self.breaker.failure(KEY), None)
+        self.assertEqual(self.breaker.failure(KEY), None)
+        self.assertTrue(self.breaker.allow(KEY))
+        self.assertEqual(self.breaker.failure(KEY), 10)
+        self.assertFalse(self.breaker.allow(KEY))
+        self.assertEqual(self.breaker.retry_in(KEY), 10)
+        self.assertEqual(self.breaker.stats(), {'open': 1, 'opened': 1, 'rejected': 1})
+
+    def test_answer_resets_the_count(self):
+        self.breaker.failure(KEY)
+        self.breaker.failure(KEY)
+        self.assertFalse(self.breaker.success(KEY))
+        self.assertEqual(self.breaker.failure(KEY), None)
+        self.assertTrue(self.breaker.allow(KEY))
+
+    def test_half_open_probe_closes(self):
+        self.open()
+        self.clock.now += 10
+        # one probe goes through, the other requests still fail at once
+        self.assertTrue(self.breaker.allow(KEY))
+        self.assertFalse(self.breaker.allow(KEY))
+        self.assertTrue(self.breaker.success(KEY))
+        self.assertTrue(self.breaker.allow(KEY))
+        self.assertTrue(self.breaker.allow(KEY))
+        self.assertEqual(self.breaker.stats()['open'], 0)
+
+    def test_failed_probe_doubles_the_backoff(self):
+        self.open()
+        self.clock.now += 10
+        self.assertTrue(self.breaker.allow(KEY))
+        self.assertEqual(self.breaker.failure(KEY), 20)
+        self.clock.now += 19
+        self.assertFalse(self.breaker.allow(KEY))
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow(KEY))
+        # at most max_backoff
+        self.assertEqual(self.breaker.failure(KEY), 30)
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow(KEY))
+        self.assertEqual(self.breaker.failure(KEY), 30)
+
+    def test_late_failure_does_not_reopen(self):
+        self.open()
+        # a request sent before the circuit opened fails afterwards
+        self.assertEqual(self.breaker.failure(KEY), None)
+        self.assertEqual(self.breaker.retry_in(KEY), 10)
+
+    def test_lost_probe_given_up(self):
+        self.open()
+        self.clock.now += 10
+        self.assertTrue(self.breaker.allow(KEY))
+        # the probe never reports back
+        self.clock.now += 4
+        self.assertFalse(self.breaker.allow(KEY))
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow(KEY))
+
+
+if __name__ == '__main__':
+    unittest.main()
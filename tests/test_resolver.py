@@ -0,0 +1,121 @@
+'''
+> Tests of the name lookup cache of the proxy server (Resolver), with a stub
+  lookup and a clock moved by hand
+> Usage: python -m unittest discover tests
+'''
+
+import sys, os
+import socket
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import myProxyServer2
+from myProxyServer2 import Resolver
+
+
+# the time as Resolver sees it, moved by the tests
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+# answers the names it is given, counts the lookups
+class StubLookup:
+    def __init__(self, answers):
+        self.answers = answers
+        self.calls = 0
+
+    def __call__(self, host):
+        self.calls += 1
+        answer = self.answers[host]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+class ResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.monotonic = myProxyServer2.monotonic
+        self.start_new_thread = myProxyServer2.start_new_thread
+        myProxyServer2.monotonic = self.clock
+        # the refresh runs at once instead of in a thread
+        myProxyServer2.start_new_thread = lambda func, args: func(*args)
+
+    def tearDown(self):
+        myProxyServer2.monotonic = self.monotonic
+        myProxyServer2.start_new_thread = self.start_new_thread
+
+    def resolver(self, answers, refresh_hits=3):
+        lookup = StubLookup(answers)
+        return Resolver(60, 5, refresh_hits, 0.5, lookup=lookup), lookup
+
+    def test_kept_for_ttl(self):
+        resolver, lookup = self.resolver({'a.test': ['10.0.0.1', '10.0.0.2']})
+        self.assertEqual(resolver.resolve('a.test'), '10.0.0.1')
+        self.clock.now += 59
+        self.assertEqual(resolver.resolve('a.test'), '10.0.0.1')
+        self.assertEqual(lookup.calls, 1)
+        self.clock.now += 1
+        self.assertEqual(resolver.get('a.test'), None)
+        lookup.answers['a.test'] = ['10.0.0.3']
+        self.assertEqual(resolver.resolve('a.test'), '10.0.0.3')
+        self.assertEqual(lookup.calls, 2)
+
+    def test_failure_kept_for_negative_ttl(self):
+        error = socket.gaierror(socket.EAI_NONAME, 'not found')
+        resolver, lookup = self.resolver({'down.test': error})
+        self.assertRaises(socket.gaierror, resolver.resolve, 'down.test')
+        self.clock.now += 4
+        # the error again, the lookup is not asked
+        self.assertRaises(socket.gaierror, resolver.resolve, 'down.test')
+        self.assertEqual(lookup.calls, 1)
+        self.clock.now += 1
+        lookup.answers['down.test'] = ['10.0.0.9']
+        self.assertEqual(resolver.resolve('down.test'), '10.0.0.9')
+        self.assertEqual(lookup.calls, 2)
+        self.assertEqual(resolver.stats()['failures'], 1)
+
+    def test_no_address_is_a_failure(self):
+        resolver, lookup = self.resolver({'empty.test': []})
+        self.assertRaises(socket.gaierror, resolver.resolve, 'empty.test')
+        self.assertRaises(socket.gaierror, resolver.resolve, 'empty.test')
+        self.assertEqual(lookup.calls, 1)
+
+    def test_popular_name_refreshed(self):
+        resolver, lookup = self.resolver({'hot.test': ['10.0.0.1']}, refresh_hits=2)
+        resolver.resolve('hot.test')
+        lookup.answers['hot.test'] = ['10.0.0.2']
+        # not before refresh_after of the ttl
+        self.clock.now += 20
+        resolver.get('hot.test')
+        resolver.get('hot.test')
+        self.assertEqual(lookup.calls, 1)
+        self.clock.now += 15
+        # the hit that asks for the refresh still gets the old address
+        self.assertEqual(resolver.get('hot.test'), '10.0.0.1')
+        self.assertEqual(lookup.calls, 2)
+        self.assertEqual(resolver.get('hot.test'), '10.0.0.2')
+        # kept for a whole ttl from the refresh, past the first expiry
+        self.clock.now += 29
+        self.assertEqual(resolver.get('hot.test'), '10.0.0.2')
+        self.assertEqual(resolver.stats()['refreshes'], 1)
+
+    def test_failed_refresh_keeps_addresses(self):
+        resolver, lookup = self.resolver({'hot.test': ['10.0.0.1']}, refresh_hits=1)
+        resolver.resolve('hot.test')
+        lookup.answers['hot.test'] = socket.gaierror(socket.EAI_AGAIN, 'try again')
+        self.clock.now += 30
+        self.assertEqual(resolver.get('hot.test'), '10.0.0.1')
+        self.assertEqual(lookup.calls, 2)
+        self.assertEqual(resolver.get('hot.test'), '10.0.0.1')
+        # until they expire
+        self.clock.now += 30
+        self.assertEqual(resolver.get('hot.test'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
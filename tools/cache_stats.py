@@ -0,0 +1,39 @@
+'''
+> Prints what is in the cache from its index (cache/index.db), without
+  reading the cache directory
+> The index is saved by the proxy every few seconds, the last changes
+  may be missing
+> Usage: python tools/cache_stats.py [directory the proxy runs in] [number of entries listed]
+'''
+
+import sys, os
+import time
+import sqlite3
+
+
+def show(db, count):
+    now = time.time()
+    files, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+    stale = db.execute('SELECT COUNT(*) FROM entries WHERE expires <= ?', (now,)).fetchone()[0]
+    unknown = db.execute('SELECT COUNT(*) FROM entries WHERE expires IS NULL').fetchone()[0]
+    print('files: {}   bytes: {}   stale: {}   freshness not known: {}'.format(files, size, stale, unknown))
+    print('\nlargest:')
+    for path, size in db.execute('SELECT path, size FROM entries ORDER BY size DESC LIMIT ?', (count,)):
+        print('{:>12}  {}'.format(size, path))
+    print('\nleast recently used (evicted first):')
+    for path, atime in db.execute('SELECT path, atime FROM entries ORDER BY atime LIMIT ?', (count,)):
+        print('{:>12.0f}s ago  {}'.format(now - atime, path))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        os.chdir(sys.argv[1])
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    path = os.path.join('cache', 'index.db')
+    if not os.path.exists(path):
+        sys.exit('No cache index at ' + os.path.abspath(path))
+    db = sqlite3.connect(path)
+    try:
+        show(db, count)
+    finally:
+        db.close()
@@ -0,0 +1,67 @@
+'''
+> Moves a cache directory from the old layout to the hashed one
+  old: cache/<host>/<url with '/' -> '_', '?' -> '~', ':' -> '_~_'>.cache
+  new: cache/ab/cd/<sha1 of the url>.cache with its url in a .meta file
+> The url is read back from the old file name, a url that had '_' or '~'
+  in it comes back wrong and its entry is a miss from then on
+> Run it once with the proxy stopped
+> Usage: python tools/migrate_cache.py [directory the proxy runs in]
+'''
+
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from myProxyServer2 import Server
+
+
+# the url a file name of the old layout was made from
+def old_url(host, name):
+    path = name[:-len('.cache')]
+    path = path.replace('_~_', ':')
+    path = path.replace('~', '?')
+    path = path.replace('_', '/')
+    if '://' in path:
+        return path
+    return 'http://' + host + path
+
+
+# a shard directory of the new layout, not a host
+def is_shard(name):
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+
+def migrate(server, root):
+    moved = 0
+    removed = 0
+    for host in sorted(os.listdir(root)):
+        dir = os.path.join(root, host)
+        if is_shard(host) or not os.path.isdir(dir):
+            continue
+        for name in sorted(os.listdir(dir)):
+            path = os.path.join(dir, name)
+            if not name.endswith('.cache'):
+                # temp files of unfinished downloads
+                os.remove(path)
+                removed += 1
+                continue
+            url = old_url(host, name)
+            # the request line is all cache_url needs
+            header = ['GET ' + url + ' HTTP/1.1']
+            cache_dir = server.cache_path(host, header)
+            if not os.path.exists(os.path.dirname(cache_dir)):
+                server.make_dir(os.path.dirname(cache_dir))
+            server.write_meta(cache_dir, {'url': server.cache_url(host, header)})
+            os.rename(path, cache_dir)
+            moved += 1
+            print('{} -> {}'.format(url, os.path.relpath(cache_dir, root)))
+        os.rmdir(dir)
+    return moved, removed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        os.chdir(sys.argv[1])
+    # the cache paths are under <cwd>/cache, like in the proxy
+    server = Server(('', 0))
+    moved, removed = migrate(server, os.path.join(os.getcwd(), 'cache'))
+    print('moved {} cache files, removed {} temp files'.format(moved, removed))